@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""Benchmarks of hat's own request pipeline.
+
+Runs offline against a local server on a free port and writes the results as JSON, so the overhead of hat can be
+compared between versions:
+
+    python benchmarks/bench.py -o before.json
+    python benchmarks/bench.py -o after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, ROOT)
+
+import requests as r  # noqa: E402
+
+from hat import http  # noqa: E402
+from hat.transport import create_session  # noqa: E402
+from tests.server import LocalHandler, LocalServer  # noqa: E402
+
+
+def payload(items):
+    return {
+        "id": 1,
+        "name": "payload",
+        "items": [{"id": i, "name": f"item {i}", "tags": ["a", "b", "c"], "price": i * 0.5, "active": i % 2 == 0}
+                  for i in range(items)],
+    }
+
+
+# about 300 bytes and 4 MB of JSON
+PAYLOADS = {
+    "small": payload(2),
+    "large": payload(50000),
+}
+
+
+class Handler(LocalHandler):
+    bodies = {}
+
+    def do_GET(self):
+        self.reply(200, self.bodies.get(self.path.strip("/"), b"{}"), {"Content-Type": "application/json"})
+
+    def do_POST(self):
+        self.reply(201, self.request_body(), {"Content-Type": "application/json"})
+
+
+def local_server():
+    Handler.bodies = {name: json.dumps(data).encode() for name, data in PAYLOADS.items()}
+    return LocalServer(Handler)
+
+
+def measure(func, min_time, repeat):
+    """Seconds per call: the calls of a round are adjusted to take at least min_time, the best of repeat rounds
+    is the least disturbed one"""
+    func()
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or calls >= 1 << 20:
+            break
+        calls *= 2 if elapsed <= 0 else max(2, min(int(min_time / elapsed) + 1, 10))
+    rounds = [elapsed / calls]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(calls):
+            func()
+        rounds.append((time.perf_counter() - start) / calls)
+    return {"calls": calls, "min": min(rounds), "median": statistics.median(rounds)}
+
+
+def fake_result(route, data):
+    body = json.dumps(data).encode()
+    resp = r.Response()
+    resp.status_code = 200
+    resp.reason = "OK"
+    resp.headers["Content-Type"] = "application/json"
+    resp._content = body
+    resp.request = r.Request("GET", "http://localhost/").prepare()
+    return http.HTTPResult("Ok", True, route, "http://localhost/", resp)
+
+
+def micro_benchmarks(size, data):
+    storage = {"id": 7, "name": "test", "token": "secret"}
+    template = {"id": http.ToInt("{id}"), "name": "{name}", "data": data}
+    route = http.Route("/items/{id}", "POST", headers={"Authorization": "Bearer {token}"},
+                       body=template, response=http.Response(200, body=data))
+    text = json.dumps(data)
+    result = fake_result(route, data)
+
+    def to_dict():
+        result._dict = None
+        return result.to_dict()
+
+    extractor = http.Extractor("response.body-object.items.1.id", "id")
+    result.to_dict()
+    return {
+        "_do_replace": lambda: http._do_replace(template, storage),
+        "compile_template.render": lambda: route.request.body.template.render(storage),
+        "construct_request": lambda: http.construct_request(route.request, storage),
+        "Response.compare_body": lambda: route.response.compare_body(text, storage),
+        "Extractor.value_from_result": lambda: extractor.value_from_result(result),
+        "HTTPResult.to_dict": to_dict,
+    }
+
+
+def pipeline_benchmarks(host):
+    routes = {
+        "small": [http.Route("/small", "GET", response=http.Response(200, body=PAYLOADS["small"]),
+                             store=[http.Extractor("response.body-object.id", "id")]),
+                  http.Route("/", "POST", body={"id": "{id}"}, response=201)],
+        "large": [http.Route("/large", "GET", response=http.Response(200, body=PAYLOADS["large"]))],
+    }
+    session = create_session({"session": False})
+    return {size: (lambda rs: lambda: check(http.handle_routes(session, [host], rs, workers=1)))(rs)
+            for size, rs in routes.items()}
+
+
+def check(results):
+    for result in results:
+        if not result.success:
+            raise RuntimeError(result.message)
+
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(min_time, repeat, only=None):
+    results = []
+
+    def add(name, size, func):
+        if only is not None and only not in name:
+            return
+        m = measure(func, min_time, repeat)
+        results.append({"name": name, "payload": size} | m)
+        sys.stderr.write(f"{name:32} {size:6} {m['min'] * 1e6:12.1f} us/op\n")
+
+    for size, data in PAYLOADS.items():
+        for name, func in micro_benchmarks(size, data).items():
+            add(name, size, func)
+    with local_server() as server:
+        for size, func in pipeline_benchmarks(server.host).items():
+            add("handle_routes", size, func)
+    return {
+        "version": git_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "benchmarks": results,
+    }
+
+
+def compare(report, baseline, threshold):
+    """Prints the change against the baseline, returns the benchmarks which got slower than the threshold"""
+    before = {(b["name"], b["payload"]): b for b in baseline["benchmarks"]}
+    regressions = []
+    for b in report["benchmarks"]:
+        old = before.get((b["name"], b["payload"]))
+        if old is None:
+            continue
+        ratio = b["min"] / old["min"] if old["min"] > 0 else 1.0
+        sys.stderr.write(f"{b['name']:32} {b['payload']:6} {ratio:8.2f}x\n")
+        if ratio > 1 + threshold:
+            regressions.append(b)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-o", "--output", help="write the results to this file instead of stdout")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown against --compare")
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimum seconds per round")
+    parser.add_argument("--repeat", type=int, default=5, help="rounds per benchmark")
+    parser.add_argument("--only", help="only run benchmarks whose name contains this")
+    options = parser.parse_args()
+
+    report = run(options.min_time, options.repeat, options.only)
+    if options.output is not None:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    if options.compare is not None:
+        with open(options.compare) as f:
+            regressions = compare(report, json.load(f), options.threshold)
+        if len(regressions) > 0:
+            sys.stderr.write(f"{len(regressions)} benchmarks got slower by more than {options.threshold:.0%}\n")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,22 +1,25 @@
-import requests as r
 from .decorators import test
-from .http import HttpRoutesWrapper, filter_routes, filter_hosts, HTTPResult, handle_routes, CONFIG, Route
+from .http import HttpRoutesWrapper, filter_routes, filter_hosts, HTTPResult, handle_routes, current_config, Route, \
+    shard_routes, handle_host_routes
 
 
 @test(wrapper=HttpRoutesWrapper)
-def test_routes(route=None, host=None, use_session=None, config=CONFIG):
+def test_routes(route=None, host=None, use_session=None, config=None):
+    from .transport import create_session
+    config = config if config is not None else current_config()
     options = config['options']
 
     if use_session is None and 'session' in options:
         use_session = options['session']
     routes = filter_routes(route, config['routes'])
     hosts = filter_hosts(host, config['hosts'])
-    if use_session:
-        session = r.session()
-    else:
-        session = r
+    session = create_session(options, use_session)
     if len(routes) == 0:
         pass
         return HTTPResult("No routes found.", False, Route('/'), '/')
+    elif options.get('shard') is not None:
+        from .shard import parse_shard
+        host_routes = shard_routes(hosts, routes, parse_shard(options['shard']))
+        return handle_host_routes(session, host_routes, workers=options.get('parallel'))
     else:
-        return handle_routes(session, hosts, routes)
+        return handle_routes(session, hosts, routes, workers=options.get('parallel'))
@@ -0,0 +1,196 @@
+import atexit
+import base64
+import gzip
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+CASSETTE_VERSION = 1
+
+
+def body_bytes(data):
+    if data is None:
+        return b""
+    if isinstance(data, str):
+        return data.encode("utf-8")
+    if isinstance(data, bytes):
+        return data
+    return str(data).encode("utf-8")
+
+
+def interaction_key(method, url, data):
+    """Requests are told apart by their method, rendered url and a hash of their body"""
+    digest = hashlib.sha256(body_bytes(data)).hexdigest()[:16]
+    return method.upper() + " " + url + " " + digest
+
+
+def encode_body(content):
+    try:
+        return {"text": content.decode("utf-8")}
+    except UnicodeDecodeError:
+        return {"base64": base64.b64encode(content).decode("ascii")}
+
+
+def decode_body(body):
+    if "text" in body:
+        return body["text"].encode("utf-8")
+    return base64.b64decode(body["base64"])
+
+
+def open_file(path, mode, compress=None):
+    if compress is None:
+        compress = path.endswith(".gz")
+    if compress:
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+@contextmanager
+def file_lock(path):
+    """Keeps other processes from writing the file at the same time, where the platform has file locks"""
+    if fcntl is None:
+        yield
+        return
+    with open(path + ".lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class Cassette:
+    """Request/response pairs on disk. Identical requests are replayed in the order they were recorded."""
+    def __init__(self, path):
+        self.path = path
+        self.interactions = {}
+        self.recorded = set()
+        self.replayed = {}
+        self.lock = threading.Lock()
+
+    def read(self):
+        try:
+            with open_file(self.path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        if data.get("version") != CASSETTE_VERSION:
+            raise ValueError(f"Unsupported cassette version in '{self.path}'")
+        return data["interactions"]
+
+    def load(self):
+        with self.lock:
+            self.interactions = self.read()
+        return self
+
+    def save(self):
+        """Writes the interactions recorded by this process, other interactions in the file are kept. Workers of a
+        process pool save into the same file."""
+        with self.lock:
+            if len(self.recorded) == 0:
+                return
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            with file_lock(self.path):
+                interactions = self.read()
+                for key in self.recorded:
+                    interactions[key] = self.interactions[key]
+                tmp = self.path + "." + str(os.getpid())
+                with open_file(tmp, "w", self.path.endswith(".gz")) as f:
+                    json.dump({"version": CASSETTE_VERSION, "interactions": interactions}, f, separators=(",", ":"))
+                os.replace(tmp, self.path)
+
+    def record(self, method, url, data, resp, content):
+        key = interaction_key(method, url, data)
+        entry = {
+            "status": resp.status_code,
+            "reason": resp.reason,
+            "headers": list(resp.headers.items()),
+            "body": encode_body(content),
+        }
+        with self.lock:
+            # a new recording replaces the one from an earlier run
+            if key not in self.recorded:
+                self.recorded.add(key)
+                self.interactions[key] = []
+            self.interactions[key].append(entry)
+
+    def replay(self, method, url, headers=None, data=None):
+        key = interaction_key(method, url, data)
+        with self.lock:
+            entries = self.interactions.get(key)
+            if not entries:
+                raise LookupError(f"No recorded response for {method.upper()} {url} in '{self.path}'")
+            index = self.replayed.get(key, 0)
+            self.replayed[key] = index + 1
+            entry = entries[min(index, len(entries) - 1)]
+        return replayed_response(entry, method, url, headers, data)
+
+
+def replayed_response(entry, method, url, headers, data):
+    from .transport import buffered_response
+    return buffered_response(entry["status"], entry["reason"], entry["headers"], decode_body(entry["body"]), method,
+                             url, headers, data)
+
+
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+
+def cassette(path):
+    """The cassette of a path, shared by all sessions of the process and saved when the process exits, or by a
+    worker of a process pool after its tests"""
+    path = os.path.abspath(path)
+    with _cassettes_lock:
+        if path not in _cassettes:
+            _cassettes[path] = Cassette(path).load()
+        return _cassettes[path]
+
+
+def save_cassettes():
+    with _cassettes_lock:
+        cassettes = list(_cassettes.values())
+    for c in cassettes:
+        c.save()
+
+
+atexit.register(save_cassettes)
+
+
+class CassetteSession:
+    """Records every response of the wrapped session to a cassette, or replays them from it without any network"""
+    def __init__(self, session, cassette, replay=False):
+        self.session = session
+        self.cassette = cassette
+        self.replay = replay
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def request(self, method, url, headers=None, data=None, **kwargs):
+        if self.replay:
+            return self.cassette.replay(method, url, headers, data)
+        from .transport import on_body
+        resp = self.session.request(method, url, headers=headers, data=data, **kwargs)
+        on_body(resp, lambda content, truncated: self.cassette.record(method, url, data, resp, content),
+                kwargs.get('stream', False))
+        return resp
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
@@ -1,7 +1,11 @@
 import json
 import sys
 import os
-from .main import name_to_python, import_tests, run, runall, list_tests, setup
+from .main import name_to_python, load_suite, run_tests, runall, runall_names, shard_names, list_tests, describe, \
+    setup, is_success
+from . import discovery
+from .history import History, slowest
+from . import shard
 
 
 OK = '\033[92m'
@@ -9,24 +13,40 @@ FAIL = '\033[91m'
 ENDC = '\033[0m'
 
 
+def result_record(results):
+    assert len(results) == 2
+    lines = results[0]
+    result = results[1]
+    if hasattr(result, 'to_dict'):
+        sys.stderr.write("\n".join(lines))
+        return dict(result.to_dict())
+    return {"success": bool(result), "message": "\n".join(lines)}
+
+
 class JsonOutput(object):
     def __init__(self):
         self.serializable = []
 
     def write(self, results):
-        assert len(results) == 2
-        lines = results[0]
-        result = results[1]
-        if hasattr(result, 'to_dict'):
-            sys.stderr.write("\n".join(lines))
-            self.serializable.append(dict(result.to_dict()))
-        else:
-            self.serializable.append({"success": bool(result), "message": "\n".join(lines)})
+        self.serializable.append(result_record(results))
 
     def finalize(self):
         json.dump(self.serializable, sys.stdout, indent=2)
 
 
+class JsonLinesOutput(object):
+    """Writes one JSON record per result as soon as it is available, nothing is kept"""
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdout
+
+    def write(self, results):
+        self.stream.write(json.dumps(result_record(results)) + "\n")
+        self.stream.flush()
+
+    def finalize(self):
+        self.stream.flush()
+
+
 class ReadableOutput(object):
     def __init__(self, verbosity=0, color=True):
         self.summary = []
@@ -62,6 +82,7 @@ class ReadableOutput(object):
             sys.stderr.write("All tests passed\n")
             sys.stderr.write(ENDC) if self.color and sys.stderr.isatty() else None
             sys.stderr.write("\n")
+        write_cache_stats()
 
     def _output_lines(self, lines, result):
         if result:
@@ -135,11 +156,21 @@ def parse_args(argv):
             command = 'list'
         elif argv[n] == 'runall':
             command = 'runall'
+        elif argv[n] == 'load':
+            command = 'load'
+        elif argv[n] == 'watch':
+            command = 'watch'
+        elif argv[n] == 'merge':
+            command = 'merge'
+        elif argv[n] == 'serve':
+            command = 'serve'
+        elif command == 'merge' and not argv[n].startswith('-'):
+            args.append(argv[n])
         elif command is None and argv[n].startswith('-'):
             command_args.append(argv[n])
-        elif command is not None and (what is not None or command == 'runall') and argv[n].startswith('--'):
+        elif command is not None and (what is not None or command in ('runall', 'watch')) and argv[n].startswith('--'):
             args.append(argv[n])
-        elif command == 'run' or command == 'list' and not argv[n].startswith('-'):
+        elif command in ('run', 'load', 'watch') or command == 'list' and not argv[n].startswith('-'):
             what = argv[n]
         elif command is None and not argv[n].startswith('-'):
             command = 'run'
@@ -155,17 +186,90 @@ def print_help(lines):
 
 
 def print_usage():
-    print("Usage: hat [-j] [-f={testfile}] [run] test_name [--arg1=value] [--arg2=value] ... | list [test_name] | runall [--arg1=value] [--arg2=value] ...")
+    print("Usage: hat [-j[=lines]] [-p={workers}] [-pool={thread|process}] [-f={testfile|dir}[,...]] [-no-cache] [-failed-first] [-only-failed] [-slowest[={n}]] [-shard={i}/{n}] [-history={file}] [-record={cassette}] [-replay={cassette}] [-http-cache[=session]] [-profile[={dir}]] [-profile-top={n}] [run] test_name [--arg1=value] [--arg2=value] ... | list [test_name] | runall [--arg1=value] [--arg2=value] ... | [-c={users}] [-rps={rate}] [-d={seconds}] load test_name [--arg1=value] ... | [-interval={seconds}] watch [pattern] [--arg1=value] ... | merge report.json ... | [-port={port}] [-bind={address}] [-latency={seconds}[-{max}]] [-error-rate={fraction}] [-error-status={code}] [-seed={n}] serve")
 
 
-def load_tests(file):
-    if os.path.isfile(file):
-        return import_tests('hatfile', file)
-    else:
-        print("File not found: " + file)
+def create_output(command_args, verbosity=0):
+    if 'j' not in command_args:
+        return ReadableOutput(verbosity, True)
+    if command_args['j'] == 'lines':
+        return JsonLinesOutput()
+    return JsonOutput()
+
+
+def write_cache_stats():
+    from .httpcache import cache_stats
+    stats = cache_stats()
+    if stats is not None:
+        hits, revalidated, misses = stats
+        sys.stderr.write(f"HTTP cache: {hits} hits, {revalidated} revalidated, {misses} misses\n")
+
+
+def write_slowest(records, n):
+    n = 10 if n is True else int(n)
+    sys.stderr.write("Slowest tests:\n")
+    for name, duration in slowest(records, n):
+        sys.stderr.write(f"{duration:8.3f}s {name}\n")
+
+
+def write_profiles(command_args):
+    from .profiler import profiles, hot_functions, profile_directory
+    n = int(command_args.get('profile_top', 15))
+    tested = profiles()
+    sys.stderr.write(f"Profiles of {len(tested)} tests in {profile_directory(command_args)}:\n")
+    for profile in sorted(tested, key=lambda p: p.wall, reverse=True):
+        sys.stderr.write(str(profile) + "\n")
+    sys.stderr.write("Hot functions:\n")
+    for tottime, calls, location in hot_functions(tested, n):
+        sys.stderr.write(f"{tottime:8.3f}s {calls:8} {location}\n")
+
+
+def shard_durations(command_args, history):
+    """The durations the shards are balanced by. Only a history given with -history is the same on every machine,
+    without it every test weighs the same."""
+    return history.durations() if 'history' in command_args else None
+
+
+def merge_reports(files):
+    """Writes the JSON outputs of several shards as one JSON output"""
+    try:
+        records = shard.merge(shard.load_reports(files))
+    except (OSError, ValueError) as e:
+        print("Can't merge reports: " + str(e))
+        return 1
+    json.dump(records, sys.stdout, indent=2)
+    return 0 if all(record["success"] for record in records) else 1
+
+
+def load_tests(paths):
+    if isinstance(paths, str):
+        paths = [paths]
+    for path in paths:
+        if not os.path.exists(path):
+            print("File not found: " + path)
+            sys.exit(1)
+    try:
+        return load_suite(paths)
+    except ValueError as e:
+        print(str(e))
         sys.exit(1)
 
 
+def load_description(paths, command_args):
+    """The description of the tests for `hat list`. It is cached for single hatfiles, so the hatfile is only
+    executed again after it changed."""
+    cached = 'no_cache' not in command_args and len(paths) == 1 and os.path.isfile(paths[0])
+    description = discovery.load(paths[0]) if cached else None
+    if description is None:
+        key = discovery.file_key(paths[0]) if cached else None
+        tests = load_tests(paths)
+        setup(tests, command_args)
+        description = describe(tests)
+        if cached:
+            discovery.store(paths[0], description, key)
+    return description
+
+
 def main():
     success = True
     (command, command_args, what, args) = parse_args(sys.argv[1:])
@@ -173,24 +277,75 @@ def main():
         print_usage()
         sys.exit(1)
     command_args = parse_arguments(command_args)
-    file = command_args['f'] if 'f' in command_args else os.path.join(os.getcwd(), 'hatfile.py')
+    paths = command_args['f'].split(",") if 'f' in command_args else [os.path.join(os.getcwd(), 'hatfile.py')]
     verbosity = int(command_args['v']) if 'v' in command_args else 0
-    output = JsonOutput() if 'j' in command_args else ReadableOutput(verbosity, True)
-    tests = load_tests(file)
-    setup(tests)
+    output = create_output(command_args, verbosity)
+    if command == 'list':
+        print_help(list_tests(None, what, command_args, load_description(paths, command_args)))
+        return 0
+    if command == 'merge':
+        return merge_reports(args)
+    if 'shard' in command_args:
+        try:
+            shard.parse_shard(command_args['shard'])
+        except ValueError as e:
+            print(str(e))
+            return 1
+    if 'replay' in command_args and not os.path.exists(command_args['replay']):
+        print("Cassette not found: " + command_args['replay'])
+        return 1
+    if command == 'watch':
+        from .watch import watch
+        return watch(paths, parse_arguments(args), command_args, lambda: create_output(command_args, verbosity),
+                     what, float(command_args.get('interval', 1)))
+    tests = load_tests(paths)
+    setup(tests, command_args)
+    if command == 'serve':
+        from .serve import serve
+        return serve(tests, command_args)
     args = parse_arguments(args)
+    history = History.load(paths, command_args.get('history'))
+    records = []
     if command == 'run':
-        result = run(tests, what, args, command_args)
-        success &= result[1].success if hasattr(result[1], 'success') else bool(result[1])
-        output.write(result)
+        for result in run_tests(tests, [what], args, command_args, records):
+            success &= is_success(result)
+            output.write(result)
         output.finalize()
-    elif command == 'list':
-        print_help(list_tests(tests, what, command_args))
+        history.record(records)
+        history.save()
+        if 'profile' in command_args:
+            write_profiles(command_args)
     elif command == 'runall':
-        for result in runall(tests, args, command_args):
-            success &= result[1].success if hasattr(result[1], 'success') else bool(result[1])
+        names = runall_names(tests)
+        if 'shard' in command_args:
+            names = shard_names(names, shard.parse_shard(command_args['shard']), shard_durations(command_args, history))
+        if 'only_failed' in command_args:
+            names = history.only_failed(names)
+        elif 'failed_first' in command_args:
+            names = history.failed_first(names)
+        for result in runall(tests, args, command_args, records, names):
+            success &= is_success(result)
             output.write(result)
         output.finalize()
+        history.record(records)
+        history.save()
+        if 'profile' in command_args:
+            write_profiles(command_args)
+        if 'slowest' in command_args:
+            write_slowest(records, command_args['slowest'])
+    elif command == 'load':
+        from .load import load
+        try:
+            report = load(tests, what, args, command_args)
+        except ValueError as e:
+            output.write([[str(e)], False])
+            output.finalize()
+            return 1
+        success = report.success
+        if 'j' in command_args:
+            json.dump(report.to_dict(), sys.stdout, indent=2)
+        else:
+            report.write(sys.stdout, verbosity)
     else:
         result = (["Unknown command: " + " ".join(sys.argv)], False)
         output.write(result)
@@ -1,7 +1,16 @@
+import functools
 import inspect
 from . import main
 
 
+def dependency_names(depends):
+    if depends is None:
+        return []
+    if isinstance(depends, str) or callable(depends):
+        depends = [depends]
+    return [main.name_to_python(d if isinstance(d, str) else d.__name__) for d in depends]
+
+
 def test(*args, **kwargs):
     if 'wrapper' in kwargs:
         t = kwargs['wrapper']()
@@ -10,17 +19,20 @@ def test(*args, **kwargs):
 
     if '_builtin' in kwargs:
         t.builtin = kwargs['_builtin']
+    t.depends = dependency_names(kwargs.get('depends'))
 
     def wrapper(func):
         t.name = func.__name__
         t.args = inspect.getfullargspec(func).args
         t.func = func
 
+        @functools.wraps(func)
         def inner(*a, **kw):
             return t(*a, **kw)
 
+        inner.hat_task = t
         if t.name is not None:
-            main.tasks[t.name] = t
+            main.register(t)
         return inner
 
     return wrapper
@@ -32,16 +44,19 @@ def http_test(*args, **kwargs):
 
     if '_builtin' in kwargs:
         t.builtin = kwargs['_builtin']
+    t.depends = dependency_names(kwargs.get('depends'))
 
     def wrapper(func):
         t.name = func.__name__
         t.args = inspect.getfullargspec(func).args
         t.func = func
 
+        @functools.wraps(func)
         def inner(*a, **kw):
             return t(*a, **kw)
 
-        main.tasks[t.name] = t
+        inner.hat_task = t
+        main.register(t)
         return inner
 
     return wrapper
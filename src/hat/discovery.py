@@ -0,0 +1,47 @@
+import hashlib
+import json
+import os
+
+CACHE_VERSION = 1
+
+
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'hat')
+
+
+def cache_path(file):
+    name = hashlib.sha256(os.path.abspath(file).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir(), "discovery-" + name + ".json")
+
+
+def file_key(file):
+    stat = os.stat(file)
+    return {"version": CACHE_VERSION, "mtime": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def load(file):
+    """The cached description of a hatfile, None if there is none or the hatfile changed since"""
+    try:
+        key = file_key(file)
+        with open(cache_path(file)) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get("key") != key:
+        return None
+    return cached["description"]
+
+
+def store(file, description, key):
+    """Caches the description, key is the file_key from before the hatfile was executed"""
+    path = cache_path(file)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + "." + str(os.getpid())
+        with open(tmp, "w") as f:
+            json.dump({"key": key, "description": description}, f)
+        os.replace(tmp, path)
+    except OSError:
+        # without a cache the hatfile is executed every time, that's all
+        pass
@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+import time
+
+from .discovery import cache_dir
+
+
+def history_path(paths):
+    key = "\n".join(sorted(os.path.abspath(p) for p in paths))
+    return os.path.join(cache_dir(), "results-" + hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json")
+
+
+class History:
+    """Outcome and duration of every test of the last runs of a set of hatfiles"""
+    def __init__(self, path):
+        self.path = path
+        self.tests = {}
+
+    @classmethod
+    def load(cls, paths, path=None):
+        history = cls(path if path is not None else history_path(paths))
+        try:
+            with open(history.path) as f:
+                history.tests = json.load(f)
+        except (OSError, ValueError):
+            pass
+        return history
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + "." + str(os.getpid())
+            with open(tmp, "w") as f:
+                json.dump(self.tests, f, indent=2)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+    def record(self, records):
+        now = time.time()
+        for name, success, duration in records:
+            self.tests[name] = {"success": success, "duration": duration, "time": now}
+
+    def failed(self):
+        return [name for name, test in self.tests.items() if not test["success"]]
+
+    def duration(self, name):
+        test = self.tests.get(name)
+        return test["duration"] if test is not None else None
+
+    def durations(self):
+        return {name: test["duration"] for name, test in self.tests.items() if test["duration"] is not None}
+
+    def failed_first(self, names):
+        failed = set(self.failed())
+        return [n for n in names if n in failed] + [n for n in names if n not in failed]
+
+    def only_failed(self, names):
+        """The names which failed last time, all names if none of them failed"""
+        failed = set(self.failed())
+        selected = [n for n in names if n in failed]
+        return selected if len(selected) > 0 else names
+
+
+def slowest(records, n):
+    timed = [(name, duration) for name, _, duration in records if duration is not None]
+    return sorted(timed, key=lambda r: r[1], reverse=True)[:n]
@@ -1,19 +1,51 @@
+import asyncio
+import copy
+import hashlib
 import json
+import os
+import pickle
+import string
+import tempfile
+import threading
+import time
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 from typing import Iterable
 
-import requests as r
 from .decorators import test
-from .main import TestWrapper
+from .main import TestWrapper, current_hatfile, host_workers
+
+DEFAULT_OPTIONS = {
+    "session": True,
+    "parallel": 1,
+    "engine": "requests",
+}
 
 CONFIG = {
     "hosts": [],
     "routes": [],
-    "options": {
-        "session": True,
-    }
+    "options": dict(DEFAULT_OPTIONS)
 }
 
 
+def new_config():
+    return {"hosts": [], "routes": [], "options": dict(DEFAULT_OPTIONS)}
+
+
+def reset_config():
+    CONFIG.clear()
+    CONFIG.update(new_config())
+
+
+def current_config():
+    """The config of the hatfile whose test is running or loading, CONFIG if only one hatfile is loaded"""
+    hatfile = current_hatfile()
+    if hatfile is not None and hatfile.config is not None:
+        return hatfile.config
+    return CONFIG
+
+
 def _do_replace(data, values):
     if isinstance(data, dict):
         ret = {}
@@ -38,12 +70,102 @@ def _do_replace(data, values):
     return ret
 
 
+def _field_names(text):
+    names = set()
+    for _, field, spec, _ in string.Formatter().parse(text):
+        if field is not None:
+            names.add(field.split(".")[0].split("[")[0])
+        if spec:
+            names |= _field_names(spec)
+    return names
+
+
+class Template:
+    """A string with `{placeholder}` fields. It is parsed once, strings without fields are rendered once."""
+    def __init__(self, text):
+        self.text = text
+        try:
+            self.fields = _field_names(text)
+        except ValueError:
+            # let str.format report the broken template when it is rendered
+            self.fields = {""}
+        self.static = len(self.fields) == 0
+        self.value = text.format() if self.static else None
+
+    def render(self, values):
+        if self.static:
+            return self.value
+        return self.text.format(**values)
+
+
+class EvalTemplate:
+    """Wraps values like ToInt which compute their value from the storage"""
+    def __init__(self, value):
+        self.value = value
+        self.fields = set(getattr(value, 'fields', set()))
+        self.static = getattr(value, 'static', False)
+
+    def render(self, values):
+        return self.value.eval(values)
+
+
+class StaticTemplate:
+    def __init__(self, value):
+        self.value = value
+        self.fields = set()
+        self.static = True
+
+    def render(self, values):
+        return self.value
+
+
+class DictTemplate:
+    def __init__(self, items):
+        self.items = items
+        self.fields = set().union(*[v.fields for v in items.values()])
+        self.static = False
+
+    def render(self, values):
+        return {k: v.render(values) for k, v in self.items.items()}
+
+
+class ListTemplate:
+    def __init__(self, items):
+        self.items = items
+        self.fields = set().union(*[v.fields for v in items])
+        self.static = False
+
+    def render(self, values):
+        return [v.render(values) for v in self.items]
+
+
+def compile_template(data):
+    """Compiles a body structure once. Rendering it only touches the parts that contain placeholders,
+    static parts are shared between all renderings and must not be modified."""
+    if hasattr(data, "eval"):
+        return EvalTemplate(data)
+    elif isinstance(data, str):
+        return Template(data)
+    elif isinstance(data, dict):
+        items = {k: compile_template(v) for k, v in data.items()}
+        if all(v.static for v in items.values()):
+            return StaticTemplate({k: v.render({}) for k, v in items.items()})
+        return DictTemplate(items)
+    elif isinstance(data, list):
+        items = [compile_template(v) for v in data]
+        if all(v.static for v in items):
+            return StaticTemplate([v.render({}) for v in items])
+        return ListTemplate(items)
+    return StaticTemplate(data)
+
+
 class JSON:
     def __init__(self, data):
         self.data = data
+        self.template = compile_template(data)
 
     def __str__(self):
-        return json.dumps(self.data, sort_keys=True, indent=2)
+        return json.dumps(self.data, sort_keys=True, indent=2, default=repr)
 
     def __repr__(self):
         return self.__str__()
@@ -51,16 +173,107 @@ class JSON:
     def add_headers(self):
         return {'Content-Type': 'application/json'}
 
+    def render(self, values):
+        """The serialized body for the given values. The JSON object itself is not changed."""
+        return json.dumps(self.template.render(values), sort_keys=True, indent=2)
+
     def replace_placeholders(self, values):
-        self.data = _do_replace(self.data, values)
+        self.data = self.template.render(values)
+
+    def fields(self):
+        return self.template.fields
+
+
+MAX_DIFFS = 10
+
+
+def _json_text(value, limit=40):
+    text = json.dumps(value)
+    return text if len(text) <= limit else text[:limit - 3] + "..."
+
+
+def _path_text(path):
+    return ".".join(("body",) + path)
+
+
+def _ignored(path, ignore):
+    for pattern in ignore:
+        if len(pattern) == len(path) and all(p == "*" or p == part for p, part in zip(pattern, path)):
+            return True
+    return False
+
+
+def _compare_json(expected, actual, path, partial, ignore, diffs, max_diffs):
+    if len(diffs) >= max_diffs or _ignored(path, ignore):
+        return
+    if isinstance(expected, dict):
+        if not isinstance(actual, dict):
+            diffs.append(f"{_path_text(path)}: expected an object, got {_json_text(actual)}")
+            return
+        for k, v in expected.items():
+            if k not in actual:
+                if not _ignored(path + (k,), ignore):
+                    diffs.append(f"{_path_text(path + (k,))}: missing")
+            else:
+                _compare_json(v, actual[k], path + (k,), partial, ignore, diffs, max_diffs)
+            if len(diffs) >= max_diffs:
+                return
+        if not partial:
+            for k in actual:
+                if k not in expected and not _ignored(path + (k,), ignore):
+                    diffs.append(f"{_path_text(path + (k,))}: unexpected {_json_text(actual[k])}")
+                    if len(diffs) >= max_diffs:
+                        return
+    elif isinstance(expected, list):
+        if not isinstance(actual, list):
+            diffs.append(f"{_path_text(path)}: expected a list, got {_json_text(actual)}")
+            return
+        if len(actual) < len(expected) or (not partial and len(actual) != len(expected)):
+            diffs.append(f"{_path_text(path)}: expected {len(expected)} items, got {len(actual)}")
+            return
+        for i, v in enumerate(expected):
+            _compare_json(v, actual[i], path + (str(i),), partial, ignore, diffs, max_diffs)
+            if len(diffs) >= max_diffs:
+                return
+    elif not _same_value(expected, actual):
+        diffs.append(f"{_path_text(path)}: expected {_json_text(expected)}, got {_json_text(actual)}")
+
+
+def _same_value(expected, actual):
+    # JSON booleans are no numbers, in Python they are
+    if isinstance(expected, bool) or isinstance(actual, bool):
+        return expected is actual
+    return expected == actual
+
+
+def compare_json(expected, actual, partial=False, ignore=None, max_diffs=MAX_DIFFS):
+    """Compares two parsed JSON documents and returns up to max_diffs differences as `path: message`.
+
+    With partial, objects may have additional keys and lists additional trailing items.
+    Ignored paths are dotted like extractor paths (`items.*.updatedAt`), `*` matches any key or index.
+    """
+    diffs = []
+    ignore = [tuple(p.split(".")) for p in ignore] if ignore is not None else []
+    _compare_json(expected, actual, (), partial, ignore, diffs, max_diffs)
+    return diffs
 
 
 class Response:
-    def __init__(self, code, status=None, headers=None, body=None):
+    def __init__(self, code, status=None, headers=None, body=None, max_time=None, max_ttfb=None, max_bytes=None,
+                 partial=False, ignore=None, sha256=None, length=None, cacheable=None):
         self.code = code
         self.status = status
-        self.headers = None
+        self.headers = headers
         self.body = body
+        self.body_template = compile_template(body) if isinstance(body, dict) or isinstance(body, list) else None
+        self.partial = partial
+        self.ignore = ignore
+        self.sha256 = sha256.lower() if sha256 is not None else None
+        self.length = length
+        self.max_time = max_time
+        self.max_ttfb = max_ttfb
+        self.max_bytes = max_bytes
+        self.cacheable = cacheable
 
     def __str__(self):
         if self.status is not None:
@@ -71,24 +284,86 @@ class Response:
         return self.__str__()
 
     def compare_body(self, other, vars={}):
+        return len(self.body_diff(other, vars)) == 0
+
+    def body_diff(self, other, vars={}):
         if self.body is None:
-            return True
+            return []
         elif isinstance(self.body, dict) or isinstance(self.body, list):
-            d = _do_replace(self.body, vars)
-            body = json.dumps(d, sort_keys=True, indent=2)
-            other_body = json.dumps(json.loads(other), sort_keys=True, indent=2)
-            return body == other_body
-        else:
-            return str(self.body) == str(other)
+            try:
+                other_body = json.loads(other)
+            except ValueError:
+                return ["body: not valid JSON"]
+            return compare_json(self.body_template.render(vars), other_body, self.partial, self.ignore)
+        elif str(self.body) != str(other):
+            return ["body: expected " + _json_text(str(self.body)) + ", got " + _json_text(str(other))]
+        return []
+
+    def body_reader(self, keep=True):
+        """A reader for the streamed body, which enforces max_bytes and computes the hash for the assertions"""
+        from . import transport
+        return transport.BodyReader(self.max_bytes, self.sha256 is not None, keep)
+
+    def check_download(self, body_reader):
+        messages = []
+        if self.length is not None and body_reader.size != self.length:
+            messages.append(f"Body of {body_reader.size} bytes, expected {self.length} bytes")
+        if self.sha256 is not None and body_reader.sha256() != self.sha256:
+            messages.append(f"Body SHA-256 {body_reader.sha256()}, expected {self.sha256}")
+        return messages
+
+    def check_budget(self, resp, timing=None, body_reader=None):
+        """Messages for every exceeded latency (in seconds) or body size budget"""
+        messages = []
+        if timing is not None and self.max_time is not None and timing.total is not None \
+                and timing.total > self.max_time:
+            messages.append(f"Total time {timing.total * 1000:.1f}ms exceeds budget of {self.max_time * 1000:.1f}ms")
+        if timing is not None and self.max_ttfb is not None and timing.ttfb is not None \
+                and timing.ttfb > self.max_ttfb:
+            messages.append(f"Time to first byte {timing.ttfb * 1000:.1f}ms exceeds budget of "
+                            f"{self.max_ttfb * 1000:.1f}ms")
+        if body_reader is not None:
+            if body_reader.truncated:
+                messages.append(f"Body download stopped, body exceeds budget of {self.max_bytes} bytes")
+        elif self.max_bytes is not None and resp.content is not None and len(resp.content) > self.max_bytes:
+            messages.append(f"Body of {len(resp.content)} bytes exceeds budget of {self.max_bytes} bytes")
+        return messages
+
+    def check_cacheable(self, resp):
+        """Messages if the response is not cacheable although it should be, or the other way round"""
+        if self.cacheable is None:
+            return []
+        from .httpcache import uncacheable_reasons
+        reasons = uncacheable_reasons(resp)
+        if self.cacheable and len(reasons) > 0:
+            return ["Response is not cacheable: " + ", ".join(reasons)]
+        if not self.cacheable and len(reasons) == 0:
+            return ["Response is cacheable, expected it not to be"]
+        return []
+
+    def fields(self):
+        return self.body_template.fields if self.body_template is not None else set()
 
 
 class Request:
     def __init__(self, headers={}, body=None):
         self.headers = headers
+        self.header_templates = {k: Template(v) for k, v in headers.items()}
+        self.body_template = None
         if isinstance(body, dict) or isinstance(body, list):
             self.body = JSON(body)
         else:
             self.body = body
+            if isinstance(body, str):
+                self.body_template = Template(body)
+
+    def fields(self):
+        fields = set().union(*[t.fields for t in self.header_templates.values()])
+        if self.body_template is not None:
+            fields |= self.body_template.fields
+        elif hasattr(self.body, 'fields'):
+            fields |= self.body.fields()
+        return fields
 
     def __str__(self):
         return str(self.body)
@@ -100,23 +375,44 @@ class Request:
 class ToInt:
     def __init__(self, value):
         self.value = value
+        self.template = Template(value)
+        self.fields = self.template.fields
+        self.static = self.template.static
 
     def eval(self, values):
-        return int(self.value.format(**values))
+        return int(self.template.render(values))
+
+    def __repr__(self):
+        return "ToInt(" + repr(self.value) + ")"
 
 
 class ToBool:
     def __init__(self, value):
         self.value = value
+        self.template = Template(value)
+        self.fields = self.template.fields
+        self.static = self.template.static
 
     def eval(self, values):
-        return bool(self.value.format(**values))
+        return bool(self.template.render(values))
+
+    def __repr__(self):
+        return "ToBool(" + repr(self.value) + ")"
+
+
+def list_index(part):
+    """The index a path part stands for in a list, like 1 or -1"""
+    try:
+        return int(part)
+    except ValueError:
+        return None
 
 
 class Extractor:
     def __init__(self, path, key):
         self.path = path
         self.key = key
+        self.parts = [(part, list_index(part)) for part in path.split('.')]
 
     def __str__(self):
         return self.path + " -> " + self.key
@@ -125,25 +421,23 @@ class Extractor:
         return self.__str__()
 
     def path_parts(self):
-        return self.path.split('.')
+        return [part for part, _ in self.parts]
 
     def value_from_result(self, result):
-        parts = self.path_parts()
-        obj = result
-        for part in parts:
-            try:
+        obj = result.to_dict() if hasattr(result, 'to_dict') else result
+        for part, index in self.parts:
+            if index is not None and not isinstance(obj, dict):
+                obj = obj[index]
+            else:
                 obj = obj[part]
-            except TypeError:
-                try:
-                    obj = obj[int(part)]
-                except Exception as e:
-                    raise e
         return obj
 
 
 class Route:
-    def __init__(self, path, method="GET", request=None, response=200, headers={}, body=None, store=None, doc=None):
+    def __init__(self, path, method="GET", request=None, response=200, headers={}, body=None, store=None, doc=None,
+                 max_time=None, max_ttfb=None, max_bytes=None):
         self.path = path
+        self.path_template = Template(path)
         self.method = method
         self.doc = doc
         self.store = store
@@ -156,6 +450,15 @@ class Route:
             self.response = Response(response)
         else:
             self.response = response
+        if max_time is not None or max_ttfb is not None or max_bytes is not None:
+            # the response may be shared with other routes, the budgets are only for this one
+            self.response = copy.copy(self.response)
+        if max_time is not None:
+            self.response.max_time = max_time
+        if max_ttfb is not None:
+            self.response.max_ttfb = max_ttfb
+        if max_bytes is not None:
+            self.response.max_bytes = max_bytes
 
     def __str__(self):
         if self.doc is not None:
@@ -163,47 +466,99 @@ class Route:
         else:
             return self.path + " " + self.method
 
+    def variables(self):
+        """Names of the storage values the route uses"""
+        fields = set(self.path_template.fields)
+        if hasattr(self.request, 'fields'):
+            fields |= self.request.fields()
+        if hasattr(self.response, 'fields'):
+            fields |= self.response.fields()
+        return sorted(f for f in fields if f != "")
+
+    def stores(self):
+        """Names of the storage values the route sets"""
+        return [store.key for store in self.store] if self.store is not None else []
+
     def __repr__(self):
         return self.__str__()
 
 
-def visit(routes, hosts=None, session=None, storage=None, config=CONFIG):
+def route_chains(routes):
+    """Groups of route indexes which share values through the storage, every group in route order"""
+    parent = list(range(len(routes)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    stored_by = {}
+    for i, route in enumerate(routes):
+        for variable in route.variables():
+            if variable in stored_by:
+                parent[find(i)] = find(stored_by[variable])
+        for key in route.stores():
+            stored_by[key] = i
+    chains = {}
+    for i in range(len(routes)):
+        chains.setdefault(find(i), []).append(i)
+    return sorted(chains.values(), key=lambda chain: chain[0])
+
+
+def shard_routes(hosts, routes, shard):
+    """The (host, routes) pairs of the shard (i, n). Routes sharing values through the storage of a host stay on the
+    same shard, cookies of a session are not taken into account."""
+    from .shard import select
+    chains = route_chains(routes)
+    units = [(h, chain) for h in range(len(hosts)) for chain in chains]
+    per_host = {}
+    for h, chain in select(units, [len(chain) for _, chain in units], shard):
+        per_host.setdefault(h, set()).update(chain)
+    return [(hosts[h], [routes[i] for i in sorted(per_host[h])]) for h in sorted(per_host)]
+
+
+def visit(routes, hosts=None, session=None, storage=None, config=None):
+    config = config if config is not None else current_config()
     options = config['options']
     if hosts is None:
         hosts = config['hosts']
     if session is None:
-        if 'session' in options:
-            session = r if not options['session'] else r.session()
-        else:
-            session = r
-    return handle_routes(session, hosts, routes, storage)
+        from . import transport
+        session = transport.create_session(options)
+    return handle_routes(session, hosts, routes, storage, options.get('parallel'))
 
 
 def create_session():
-    return r.session()
+    from . import transport
+    return transport.create_session(current_config()['options'], True)
 
 
 def set_urls(urls):
-    global CONFIG
-    CONFIG['routes'] = CONFIG['routes'] + urls
+    config = current_config()
+    config['routes'] = config['routes'] + urls
 
 
 def set_hosts(hosts):
-    global CONFIG
-    CONFIG['hosts'] = CONFIG['hosts'] + hosts
+    config = current_config()
+    config['hosts'] = config['hosts'] + hosts
 
 
 def set_options(options):
-    global CONFIG
-    if CONFIG['options'] is None:
-        CONFIG['options'] = {}
-    for k, v in CONFIG["options"].items():
-        options[k] = v
+    config = current_config()
+    if config['options'] is None:
+        config['options'] = {}
+    for k, v in options.items():
+        config["options"][k] = v
 
 
 def set_config(config):
     global CONFIG
-    CONFIG = config
+    hatfile = current_hatfile()
+    if hatfile is not None and hatfile.config is not None:
+        hatfile.config = config
+    else:
+        CONFIG = config
 
 
 def url(root, path):
@@ -214,21 +569,54 @@ def url(root, path):
     return root + path
 
 
+class RenderedRequest(Mapping):
+    """The request parameters of one invocation of a route. Routes themselves are never changed by rendering,
+    so they can be shared between hosts, threads and repeated runs."""
+    def __init__(self, headers, data=None):
+        self._params = {'headers': MappingProxyType(headers)}
+        if data is not None:
+            self._params['data'] = data
+
+    @property
+    def headers(self):
+        return self._params['headers']
+
+    @property
+    def data(self):
+        return self._params.get('data')
+
+    def __getitem__(self, key):
+        value = self._params[key]
+        # requests merges the headers into a dict of its own
+        return dict(value) if key == 'headers' else value
+
+    def __iter__(self):
+        return iter(self._params)
+
+    def __len__(self):
+        return len(self._params)
+
+
 def construct_request(request, storage):
-    params = {'headers': {}}
-    for k, v in request.headers.items():
-        params['headers'][k] = v.format(**storage)
+    templates = getattr(request, 'header_templates', None)
+    if templates is None:
+        templates = {k: Template(v) for k, v in request.headers.items()}
+    headers = {k: t.render(storage) for k, t in templates.items()}
+    body = None
     if request.body is not None:
-        if hasattr(request.body, 'replace_placeholders'):
+        if hasattr(request.body, 'render'):
+            body = request.body.render(storage)
+        elif hasattr(request.body, 'replace_placeholders'):
             request.body.replace_placeholders(storage)
             body = str(request.body)
+        elif getattr(request, 'body_template', None) is not None:
+            body = request.body_template.render(storage)
         else:
             body = str(request.body).format(**storage)
-        params['data'] = body
         if hasattr(request.body, 'add_headers'):
-            params['headers'] = request.body.add_headers() | params['headers']
+            headers = request.body.add_headers() | headers
 
-    return params
+    return RenderedRequest(headers, body)
 
 
 def compare_response(resp, response, vars=None):
@@ -239,6 +627,21 @@ def compare_response(resp, response, vars=None):
     return True
 
 
+def check_response(resp, response, vars=None, timing=None, body_reader=None):
+    if resp.status_code != response.code:
+        messages = [f"Unexpected response: status code {resp.status_code}, expected {response.code}"]
+    elif body_reader is not None and body_reader.truncated:
+        # the body is incomplete, comparing it would only report follow-up errors
+        messages = []
+    else:
+        messages = response.check_download(body_reader) if body_reader is not None else []
+        if resp.content is not None:
+            diffs = response.body_diff(resp.content.decode("utf-8"), vars)
+            if len(diffs) > 0:
+                messages.append("Unexpected response: " + "; ".join(diffs))
+    return messages + response.check_budget(resp, timing, body_reader) + response.check_cacheable(resp)
+
+
 def filter_routes(route, routes):
     if route is None:
         return routes
@@ -259,28 +662,99 @@ def filter_hosts(host, hosts):
     return host.split(',')
 
 
+RETENTION_POLICIES = ("all", "failures", "spill")
+
+
+class SpillFile:
+    """An append only temporary file, which keeps the details of passed results out of memory"""
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def write(self, obj):
+        data = json.dumps(obj).encode("utf-8")
+        with self.lock:
+            self.file.seek(0, os.SEEK_END)
+            offset = self.file.tell()
+            self.file.write(data)
+        return self, offset, len(data)
+
+    def read(self, offset, size):
+        with self.lock:
+            self.file.seek(offset)
+            data = self.file.read(size)
+        return json.loads(data)
+
+
+_spill_file = None
+_spill_lock = threading.Lock()
+
+
+def spill_file():
+    global _spill_file
+    with _spill_lock:
+        # forked test processes must not share the file position with their parent
+        if _spill_file is None or _spill_file.pid != os.getpid():
+            _spill_file = SpillFile()
+        return _spill_file
+
+
 class HTTPCollectionResult:
-    def __init__(self, name, results):
+    def __init__(self, name, results, retain=None):
         self.name = name
         self.title = name
-        success = True
-        if isinstance(results, list):
-            self.results = results
-            for r in self.results:
-                success = success and r.success if hasattr(r, 'success') else r
-            self.success = success
-        elif isinstance(results, HTTPCollectionResult):
-            self.results = results.results
-            self.success = results.success
+        if retain is None:
+            retain = current_config()['options'].get('retain', 'all')
+        self.retention = retain
+        self.results = []
+        self.success = True
+        self.extend(results)
+
+    def extend(self, results):
+        """Adds results, the retention policy applies to them as well"""
+        if isinstance(results, HTTPCollectionResult):
+            results = results.results
+        for r in results:
+            r = r.retain(self.retention) if hasattr(r, 'retain') else r
+            self.results.append(r)
+            self.success = self.success and (r.success if hasattr(r, 'success') else bool(r))
+
+    def timing(self):
+        timings = [r.timing for r in self.results if getattr(r, 'timing', None) is not None]
+        if len(timings) == 0:
+            return None
+        totals = [t.total for t in timings if t.total is not None]
+        result = {"requests": len(timings)}
+        from . import transport
+        for phase in transport.Timing.PHASES:
+            result[phase] = sum(getattr(t, phase) or 0.0 for t in timings)
+        result["mean"] = sum(totals) / len(totals) if len(totals) > 0 else None
+        result["max"] = max(totals) if len(totals) > 0 else None
+        result["request-bytes"] = sum(t.request_bytes for t in timings)
+        result["response-bytes"] = sum(t.response_bytes for t in timings)
+        return result
 
     def to_dict(self):
-        return {
+        obj = {
             "success": self.success,
             "title": self.title,
             "results": [r.to_dict() if hasattr(r, 'to_dict') else r for r in self.results]
         }
+        timing = self.timing()
+        if timing is not None:
+            obj["timing"] = timing
+        return obj
 
     def write(self, stream, verbosity=0, indent=0):
+        timing = self.timing() if verbosity >= 1 else None
+        if timing is not None:
+            stream.write(" " * (indent + 2))
+            stream.write(f"{timing['requests']} requests in {timing['total'] * 1000:.1f}ms "
+                         f"(mean {(timing['mean'] or 0) * 1000:.1f}ms, max {(timing['max'] or 0) * 1000:.1f}ms, "
+                         f"dns {timing['dns'] * 1000:.1f}ms, connect {timing['connect'] * 1000:.1f}ms, "
+                         f"tls {timing['tls'] * 1000:.1f}ms), "
+                         f"sent {timing['request-bytes']} B, received {timing['response-bytes']} B\n")
         if verbosity >= 1:
             for r in self.results:
                 if hasattr(r, "write") and hasattr(r, "success"):
@@ -294,45 +768,94 @@ class HTTPCollectionResult:
 
     def __add__(self, other):
         if not isinstance(other, HTTPCollectionResult) and not isinstance(other, list):
-            raise NotImplemented
-        if isinstance(other, HTTPCollectionResult):
-            return HTTPCollectionResult(self.name, self.results + other.results)
-        if isinstance(other, list):
-            return HTTPCollectionResult(self.name, self.results + other)
+            return NotImplemented
+        result = HTTPCollectionResult(self.name, self.results, self.retention)
+        result.extend(other)
+        return result
 
     def __iadd__(self, other):
         if not isinstance(other, HTTPCollectionResult) and not isinstance(other, list):
-            raise NotImplemented
-
-        if isinstance(other, HTTPCollectionResult):
-            self.results += other.results
-            return self
-        if isinstance(other, list):
-            self.results += other
-            return self
+            return NotImplemented
+        self.extend(other)
+        return self
 
     def __iter__(self):
         return self.results.__iter__()
 
 
+def parse_json(text):
+    if text is None:
+        return None
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
+
+
 class HTTPResult:
-    def __init__(self, message, success, route, host, response=None):
+    def __init__(self, message, success, route, host, response=None, timing=None, body_reader=None):
         self.message = message
         self.success = success
         self.route = route
         self.host = host
         self.response = response
+        self.timing = timing
+        self.body_size = body_reader.size if body_reader is not None else None
+        self.body_sha256 = body_reader.sha256() if body_reader is not None else None
         self.title = str(route) + ": " + url(host, route.path)
+        self.status_code = None
+        self.reason = None
+        self.retention = "all"
+        self._dict = None
+        self._spill = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_dict'] = None
+        if self._spill is not None:
+            # the temporary file stays behind, the details travel with the result
+            state['_dict'] = self.to_dict()
+            state['_spill'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.retention == "spill" and self._dict is not None:
+            self._spill = spill_file().write(self._dict)
+            self._dict = None
+
+    def retain(self, policy):
+        """Applies a retention policy. Failures always keep all details, for passed results 'failures' only keeps
+        the summary and 'spill' moves the details to a temporary file."""
+        if policy not in RETENTION_POLICIES:
+            raise ValueError(f"Unknown retention policy: '{policy}'")
+        if policy == "all" or not self.success or self.response is None:
+            return self
+        if policy == "spill":
+            self._spill = spill_file().write(self.to_dict())
+        self.retention = policy
+        self.status_code = self.response.status_code
+        self.reason = self.response.reason
+        self.response = None
+        self._dict = None
+        return self
+
+    def drop_body(self):
+        """Frees the response body once the assertions and extractors are done"""
+        if self.response is not None:
+            self.response._content = None
+        self._dict = None
 
     def to_dict(self):
-        try:
-            response_json = json.loads(self.response.content.decode())
-        except:
-            response_json = None
-        try:
-            request_json = json.loads(self.response.body.decode())
-        except:
-            request_json = None
+        """The dict view of the result. It is built once, callers must not modify it."""
+        if self._spill is not None:
+            spill, offset, size = self._spill
+            return spill.read(offset, size)
+        if self._dict is None:
+            self._dict = self._build_dict()
+        return self._dict
+
+    def _build_dict(self):
         obj = {
             "success": self.success,
             "message": self.message,
@@ -340,21 +863,32 @@ class HTTPResult:
             "method": self.route.method,
         }
         if self.response is not None:
+            request_body = self.response.request.body
+            # a body cut off at its budget may end in the middle of a character
+            content = self.response.content.decode(errors="replace") if self.response.content is not None else None
             obj |= {
                 "request": {
                     "url": self.response.request.url,
                     "headers": dict(self.response.request.headers),
-                    "body": self.response.request.body,
-                    "body-object": request_json
+                    "body": request_body,
+                    "body-object": parse_json(request_body)
                 },
                 "response": {
                     "status-code": self.response.status_code,
                     "status": self.response.reason,
                     "headers": dict(self.response.headers),
-                    "body": self.response.content.decode() if self.response.content is not None else None,
-                    "body-object": response_json
+                    "body": content,
+                    "body-object": parse_json(content)
                 }
             }
+            if self.body_size is not None:
+                obj["response"]["body-bytes"] = self.body_size
+            if self.body_sha256 is not None:
+                obj["response"]["body-sha256"] = self.body_sha256
+        elif self.status_code is not None:
+            obj["response"] = {"status-code": self.status_code, "status": self.reason}
+        if self.timing is not None:
+            obj["timing"] = self.timing.to_dict()
         return obj
 
     def write_json(self, stream, verbosity=0):
@@ -362,6 +896,12 @@ class HTTPResult:
 
     def write(self, stream, verbosity=0, indent=0):
         stream.write(" " * indent + self.title)
+        if self.response is None and self.status_code is not None:
+            # the details were dropped by the retention policy
+            if verbosity >= 1:
+                stream.write(" " * indent)
+                stream.write("Response: " + str(self.status_code) + " " + (self.reason or "") + "\n")
+            return
         if self.response is None and self.message is not None:
             stream.write(" " * indent + self.message)
             return
@@ -395,6 +935,9 @@ class HTTPResult:
             for k, v in self.response.headers.items():
                 stream.write(" " * indent)
                 stream.write(k + ": " + v + "\n")
+            if self.timing is not None:
+                stream.write(" " * indent)
+                stream.write("Timing: " + str(self.timing) + "\n")
         if self.response.content is not None and verbosity >= 2:
             stream.write(" " * indent)
             stream.write("Response Body:\n")
@@ -414,27 +957,47 @@ class HttpRoutesWrapper(TestWrapper):
     def __init__(self):
         super().__init__()
         self.builtin = True
+        self.shards_itself = True
 
     def __call__(self, *args, **kwargs):
-        return HTTPCollectionResult('ROUTES', self.func(*args, **kwargs))
+        name = self.hatfile.qualify('ROUTES') if self.hatfile is not None else 'ROUTES'
+        return HTTPCollectionResult(name, self.func(*args, **kwargs))
+
+    def fingerprint(self):
+        fingerprint = super().fingerprint()
+        if fingerprint is None:
+            return None
+        digest = hashlib.sha256(fingerprint.encode("utf-8"))
+        try:
+            digest.update(pickle.dumps(current_config()))
+        except Exception:
+            # without a stable view of the routes the test always counts as changed
+            return None
+        return digest.hexdigest()
 
     def short_help(self):
+        config = current_config()
         result = [self.name, "  routes:"]
-        for route in CONFIG['routes']:
+        for route in config['routes']:
             result.append("    " + str(route))
         result.append("  hosts: ")
-        for host in CONFIG['hosts']:
+        for host in config['hosts']:
             result.append("    " + str(host))
         return result
 
     def long_help(self):
+        config = current_config()
         result = [self.name, "  routes:"]
-        for i, route in enumerate(CONFIG['routes']):
+        for i, route in enumerate(config['routes']):
             result.append("   {:2}. ".format(i+1) + str(route))
             if route.doc is not None:
                 result.append("      " + route.path + " " + route.method)
+            if len(route.variables()) > 0:
+                result.append("      uses: " + ", ".join(route.variables()))
+            if len(route.stores()) > 0:
+                result.append("      stores: " + ", ".join(route.stores()))
         result.append("  hosts:")
-        for i, host in enumerate(CONFIG['hosts']):
+        for i, host in enumerate(config['hosts']):
             result.append("   {:2}. ".format(i+1) + host)
         return result
 
@@ -443,46 +1006,144 @@ class HttpWrapper(TestWrapper):
     def __call__(self, *args, **kwargs):
         return HTTPCollectionResult(self.name, self.func(*args, **kwargs))
 
+    def dependency_args(self, dependencies):
+        kwargs = super().dependency_args(dependencies)
+        if 'session' in self.args:
+            sessions = [d.kwargs['session'] for d in dependencies.values() if d.kwargs.get('session') is not None]
+            kwargs['session'] = sessions[0] if len(sessions) > 0 else create_session()
+        return kwargs
+
+
+METHODS = ("GET", "POST", "PUT", "DELETE")
+
 
-def handle_routes(session, hosts, routes, storage=None):
-    results = []
-    for host in hosts:
-        if storage is None:
-            host_storage = {}
+def response_timing(resp, total, body_reader):
+    # sessions without the timing adapter only know when the headers arrived
+    timing = getattr(resp, 'timing', None)
+    if timing is None:
+        from . import transport
+        timing = transport.Timing.from_response(resp, total)
+    if timing.total is None:
+        timing.total = total
+        timing.measure(resp)
+    timing.response_bytes = body_reader.size
+    return timing
+
+
+def needs_body(route):
+    return route.response.body is not None or (route.store is not None and len(route.store) > 0)
+
+
+def route_result(route, host, host_storage, resp, timing=None, body_reader=None, drop_bodies=False, retain="all"):
+    if resp is None:
+        result = HTTPResult(f"Unknown method: '{route.method}'", False, route, host)
+    else:
+        messages = check_response(resp, route.response, host_storage, timing, body_reader)
+        if len(messages) > 0:
+            result = HTTPResult("; ".join(messages), False, route, host, resp, timing, body_reader)
         else:
-            host_storage = storage
-        for route in routes:
-            try:
-                resp = None
-                path = route.path.format(**host_storage)
-                request = construct_request(route.request, host_storage)
-                if route.method == "GET":
-                    resp = session.get(url(host, path), **request)
-                elif route.method == "POST":
-                    resp = session.post(url(host, path), **request)
-                elif route.method == "PUT":
-                    resp = session.put(url(host, path), **request)
-                elif route.method == "DELETE":
-                    resp = session.delete(url(host, path), **request)
-                else:
-                    result = HTTPResult(f"Unknown method: '${route.method}'", False, route, host)
-                    if route.store is not None:
-                        for store in route.store:
-                            host_storage[store.key] = store.value_from_result(result.to_dict())
-                if resp is None:
-                    result = HTTPResult(f"Unknown route: '{route.path}'", False, route, host)
-                    # pass
-                elif not compare_response(resp, route.response, host_storage):
-                    result = HTTPResult("Unexpected response", False, route, host, resp)
-                    if route.store is not None:
-                        for store in route.store:
-                            host_storage[store.key] = store.value_from_result(result.to_dict())
-                else:
-                    result = HTTPResult("Ok", True, route, host, resp)
-                    if route.store is not None:
-                        for store in route.store:
-                            host_storage[store.key] = store.value_from_result(result.to_dict())
-            except Exception as e:
-                result = HTTPResult(str(e) + "\n", False, route, host)
-            results.append(result)
-    return results
+            result = HTTPResult("Ok", True, route, host, resp, timing, body_reader)
+    # a truncated body can't be parsed, the result keeps the budget message instead of an extractor error
+    truncated = body_reader is not None and body_reader.truncated
+    if resp is not None and route.store is not None and not truncated:
+        for store in route.store:
+            host_storage[store.key] = store.value_from_result(result)
+    if drop_bodies:
+        result.drop_body()
+    # as soon as the extractors are done, so passed routes don't hold their responses until the test ends
+    return result.retain(retain)
+
+
+def handle_route(session, host, route, host_storage, drop_bodies=False, retain="all"):
+    try:
+        resp = None
+        body_reader = None
+        timing = None
+        if route.method in METHODS:
+            path = route.path_template.render(host_storage)
+            request = construct_request(route.request, host_storage)
+            body_reader = route.response.body_reader(not drop_bodies or needs_body(route))
+            start = time.perf_counter()
+            resp = getattr(session, route.method.lower())(url(host, path), stream=True, **request)
+            body_reader.read(resp)
+            timing = response_timing(resp, time.perf_counter() - start, body_reader)
+        return route_result(route, host, host_storage, resp, timing, body_reader, drop_bodies, retain)
+    except Exception as e:
+        return HTTPResult(str(e) + "\n", False, route, host)
+
+
+async def handle_route_async(session, host, route, host_storage, drop_bodies=False, retain="all"):
+    try:
+        resp = None
+        body_reader = None
+        timing = None
+        if route.method in METHODS:
+            path = route.path_template.render(host_storage)
+            request = construct_request(route.request, host_storage)
+            body_reader = route.response.body_reader(not drop_bodies or needs_body(route))
+            start = time.perf_counter()
+            resp = await session.request(route.method, url(host, path), body_reader=body_reader, **request)
+            timing = response_timing(resp, time.perf_counter() - start, body_reader)
+        return route_result(route, host, host_storage, resp, timing, body_reader, drop_bodies, retain)
+    except Exception as e:
+        return HTTPResult(str(e) + "\n", False, route, host)
+
+
+def handle_host(session, host, routes, host_storage, drop_bodies=False, retain="all"):
+    return [handle_route(session, host, route, host_storage, drop_bodies, retain) for route in routes]
+
+
+async def handle_host_async(session, host, routes, host_storage, drop_bodies=False, retain="all"):
+    return [await handle_route_async(session, host, route, host_storage, drop_bodies, retain) for route in routes]
+
+
+async def handle_routes_async(session, hosts, routes, storage=None, drop_bodies=False, retain="all"):
+    return await handle_host_routes_async(session, [(host, routes) for host in hosts], storage, drop_bodies, retain)
+
+
+async def handle_host_routes_async(session, host_routes, storage=None, drop_bodies=False, retain="all"):
+    if storage is not None:
+        results = []
+        for host, routes in host_routes:
+            results += await handle_host_async(session, host, routes, storage, drop_bodies, retain)
+        return results
+
+    chains = await asyncio.gather(*[handle_host_async(session, host, routes, {}, drop_bodies, retain)
+                                    for host, routes in host_routes])
+    return [result for chain in chains for result in chain]
+
+
+def handle_routes(session, hosts, routes, storage=None, workers=None, drop_bodies=None, retain=None):
+    return handle_host_routes(session, [(host, routes) for host in hosts], storage, workers, drop_bodies, retain)
+
+
+def handle_host_routes(session, host_routes, storage=None, workers=None, drop_bodies=None, retain=None):
+    """Like handle_routes with the routes of every host given as (host, routes) pairs, e.g. by shard_routes"""
+    options = current_config()['options']
+    if drop_bodies is None:
+        drop_bodies = options.get('drop_bodies', False)
+    if retain is None:
+        retain = options.get('retain', 'all')
+    if retain not in RETENTION_POLICIES:
+        raise ValueError(f"Unknown retention policy: '{retain}'")
+    if getattr(session, 'asynchronous', False):
+        return session.run(handle_host_routes_async(session, host_routes, storage, drop_bodies, retain))
+
+    if workers is None:
+        workers = options.get('parallel', 1)
+    workers = host_workers(int(workers) if workers else 1)
+    # a shared storage chains the hosts together, so they have to run one after another
+    if storage is not None or workers <= 1 or len(host_routes) <= 1:
+        results = []
+        for host, routes in host_routes:
+            if storage is None:
+                host_storage = {}
+            else:
+                host_storage = storage
+            results += handle_host(session, host, routes, host_storage, drop_bodies, retain)
+        return results
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(host_routes))) as executor:
+        chains = executor.map(lambda pair: handle_host(session, pair[0], pair[1], {}, drop_bodies, retain),
+                              host_routes)
+        return [result for chain in chains for result in chain]
@@ -0,0 +1,281 @@
+import copy
+import email.utils
+import threading
+import time
+
+from requests.structures import CaseInsensitiveDict
+
+# statuses which may be stored without explicit freshness information, RFC 9110 15.1
+CACHEABLE_STATUS = {200, 203, 204, 206, 300, 301, 308, 404, 405, 410, 414, 501}
+
+
+def cache_control(headers):
+    directives = {}
+    for part in (headers or {}).get("Cache-Control", "").split(","):
+        name, _, value = part.strip().partition("=")
+        if name != "":
+            directives[name.lower()] = value.strip('"') if value != "" else True
+    return directives
+
+
+def _seconds(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _date(value):
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def freshness_lifetime(headers):
+    """Seconds a response stays fresh for a private cache, 0 if it has to be revalidated before every use"""
+    directives = cache_control(headers)
+    if "no-cache" in directives:
+        return 0
+    if "max-age" in directives:
+        return _seconds(directives["max-age"])
+    if "Expires" in headers:
+        expires = _date(headers["Expires"])
+        date = _date(headers.get("Date")) or time.time()
+        return max(0, int(expires - date)) if expires is not None else 0
+    return 0
+
+
+def has_validator(headers):
+    return "ETag" in headers or "Last-Modified" in headers
+
+
+def has_credentials(request_headers):
+    return "Authorization" in request_headers or "Cookie" in request_headers
+
+
+def uncacheable_reasons(resp):
+    """Why a cache couldn't reuse the response, an empty list if it can"""
+    reasons = []
+    directives = cache_control(resp.headers)
+    if resp.status_code not in CACHEABLE_STATUS:
+        reasons.append(f"status {resp.status_code} is not cacheable")
+    if "no-store" in directives:
+        reasons.append("Cache-Control: no-store")
+    if resp.headers.get("Vary", "").strip() == "*":
+        reasons.append("Vary: *")
+    if freshness_lifetime(resp.headers) == 0 and not has_validator(resp.headers) and "no-store" not in directives:
+        reasons.append("neither max-age, Expires, ETag nor Last-Modified")
+    return reasons
+
+
+class CacheEntry:
+    """A stored response. Entries are shared between threads, so they don't change once they are in the cache."""
+    def __init__(self, resp, content, request_headers):
+        self.status_code = resp.status_code
+        self.reason = resp.reason
+        self.headers = CaseInsensitiveDict(resp.headers)
+        self.content = content
+        self.vary = self.vary_values(request_headers)
+        self.refresh(resp.headers)
+
+    def refresh(self, headers):
+        """Takes the headers of a 304 response, which describe the stored response again"""
+        for k, v in headers.items():
+            if k.lower() not in ("content-length", "content-encoding", "transfer-encoding"):
+                self.headers[k] = v
+        self.stored = time.monotonic() - _seconds(headers.get("Age"))
+        self.lifetime = freshness_lifetime(self.headers)
+
+    def revalidated(self, headers):
+        """A copy of the entry, described again by the headers of a 304 response"""
+        entry = copy.copy(self)
+        entry.headers = CaseInsensitiveDict(self.headers)
+        entry.refresh(headers)
+        return entry
+
+    def vary_values(self, request_headers):
+        request_headers = CaseInsensitiveDict(request_headers or {})
+        names = [n.strip() for n in self.headers.get("Vary", "").split(",") if n.strip() != ""]
+        return {n.lower(): request_headers.get(n) for n in names}
+
+    def matches(self, request_headers):
+        return self.vary_values(request_headers) == self.vary
+
+    def fresh(self):
+        return time.monotonic() - self.stored < self.lifetime
+
+    def conditional_headers(self, request_headers):
+        headers = dict(request_headers or {})
+        if "ETag" in self.headers:
+            headers["If-None-Match"] = self.headers["ETag"]
+        if "Last-Modified" in self.headers:
+            headers["If-Modified-Since"] = self.headers["Last-Modified"]
+        return headers
+
+    def response(self, method, url, request_headers, data, status):
+        from .transport import buffered_response
+        resp = buffered_response(self.status_code, self.reason, self.headers, self.content, method, url,
+                                 request_headers, data)
+        resp.from_cache = status
+        return resp
+
+
+class HttpCache:
+    """A private HTTP cache for GET requests, shared by the sessions of a run"""
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, url, request_headers):
+        with self.lock:
+            entry = self.entries.get(url)
+        return entry if entry is not None and entry.matches(request_headers) else None
+
+    def store(self, url, resp, request_headers, stream=False):
+        """Stores the response once its body was read. Bodies over their size budget are not stored."""
+        if len(uncacheable_reasons(resp)) > 0:
+            return
+        from .transport import on_body
+
+        def stored(content, truncated):
+            if not truncated:
+                self.put(url, CacheEntry(resp, content, request_headers))
+
+        on_body(resp, stored, stream)
+
+    def put(self, url, entry):
+        with self.lock:
+            self.entries[url] = entry
+
+    def invalidate(self, url):
+        with self.lock:
+            self.entries.pop(url, None)
+
+    def count(self, status):
+        with self.lock:
+            setattr(self, status, getattr(self, status) + 1)
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self.hits = self.revalidated = self.misses = 0
+
+
+_caches = []
+_run_cache = None
+_caches_lock = threading.Lock()
+
+
+def http_cache(scope="run"):
+    """The cache of the run, or a new one for `session` scope"""
+    global _run_cache
+    with _caches_lock:
+        if scope == "session" or _run_cache is None:
+            cache = HttpCache()
+            _caches.append(cache)
+            if scope != "session":
+                _run_cache = cache
+            return cache
+        return _run_cache
+
+
+def reset_caches():
+    """Starts a new run: the responses and counts of the previous run are forgotten"""
+    global _run_cache
+    with _caches_lock:
+        _caches.clear()
+        _run_cache = None
+
+
+def cache_stats():
+    """(hits, revalidated, misses) of all caches of the run, None if no cache was used"""
+    with _caches_lock:
+        caches = list(_caches)
+    if len(caches) == 0:
+        return None
+    return tuple(sum(getattr(c, status) for c in caches) for status in ("hits", "revalidated", "misses"))
+
+
+class CachingSession:
+    """Answers GET requests from the cache while the stored response is fresh and revalidates it with a conditional
+    request after that. Other methods go to the wrapped session and invalidate the cached url.
+    Responses marked `private` and responses to requests with credentials, including the cookies and headers of the
+    session, are kept in a cache of this session instead of the cache of the run."""
+    def __init__(self, session, cache, scope="run"):
+        self.session = session
+        self.cache = cache
+        self.own_cache = cache if scope == "session" else None
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def sent_headers(self, method, url, headers):
+        """The headers the wrapped session sends, with its default headers and cookies"""
+        import requests
+        return self.session.prepare_request(requests.Request(method, url, headers=headers)).headers
+
+    def session_cache(self):
+        if self.own_cache is None:
+            self.own_cache = http_cache("session")
+        return self.own_cache
+
+    def caches(self, sent):
+        """The caches a response to the request may come from, the cache of the session first"""
+        if has_credentials(sent) or self.own_cache is self.cache:
+            return [self.session_cache()]
+        return [c for c in (self.own_cache, self.cache) if c is not None]
+
+    def request(self, method, url, headers=None, data=None, **kwargs):
+        if method.upper() != "GET":
+            resp = self.session.request(method, url, headers=headers, data=data, **kwargs)
+            if resp.status_code < 400:
+                self.cache.invalidate(url)
+                if self.own_cache is not None:
+                    self.own_cache.invalidate(url)
+            return resp
+        directives = cache_control(CaseInsensitiveDict(headers or {}))
+        if "no-store" in directives:
+            return self.session.request(method, url, headers=headers, data=data, **kwargs)
+        sent = self.sent_headers(method, url, headers)
+        cache, entry = self.cache, None
+        for c in self.caches(sent):
+            entry = c.lookup(url, sent)
+            if entry is not None:
+                cache = c
+                break
+        if entry is not None and entry.fresh() and "no-cache" not in directives:
+            cache.count("hits")
+            return entry.response(method, url, headers, data, "hit")
+        if entry is not None and has_validator(entry.headers):
+            resp = self.session.request(method, url, headers=entry.conditional_headers(headers), data=data, **kwargs)
+            if resp.status_code == 304:
+                resp.close()
+                entry = entry.revalidated(resp.headers)
+                cache.put(url, entry)
+                cache.count("revalidated")
+                return entry.response(method, url, headers, data, "revalidated")
+        else:
+            resp = self.session.request(method, url, headers=headers, data=data, **kwargs)
+        if has_credentials(sent) or "private" in cache_control(resp.headers):
+            cache = self.session_cache()
+        else:
+            cache = self.cache
+        cache.count("misses")
+        cache.store(url, resp, sent, kwargs.get('stream', False))
+        return resp
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
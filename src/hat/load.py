@@ -0,0 +1,267 @@
+import asyncio
+import math
+import threading
+import time
+
+from .main import tasks, name_to_python, filter_args, task_context
+from . import http
+from .http import HttpWrapper, HttpRoutesWrapper, filter_routes, filter_hosts, handle_routes
+from .transport import create_session
+
+HISTOGRAM_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.next, now)
+            self.next = start + self.interval
+        return start - now
+
+    def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class PacedSession:
+    """Waits for the rate limiter before every request of the wrapped session"""
+    def __init__(self, session, limiter):
+        self.session = session
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    async def request(self, method, url, **kwargs):
+        delay = self.limiter.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return await self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        self.limiter.wait()
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        self.limiter.wait()
+        return self.session.post(url, **kwargs)
+
+    def put(self, url, **kwargs):
+        self.limiter.wait()
+        return self.session.put(url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        self.limiter.wait()
+        return self.session.delete(url, **kwargs)
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def result_latency(result):
+    if result.timing is None:
+        return None
+    return result.timing.total
+
+
+class RouteStats:
+    def __init__(self, name):
+        self.name = name
+        self.requests = 0
+        self.errors = 0
+        self.latencies = []
+
+    def add(self, result):
+        self.requests += 1
+        if not result.success:
+            self.errors += 1
+        latency = result_latency(result)
+        if latency is not None:
+            self.latencies.append(latency)
+
+    def histogram(self):
+        counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        for latency in self.latencies:
+            ms = latency * 1000
+            i = 0
+            while i < len(HISTOGRAM_BUCKETS) and ms > HISTOGRAM_BUCKETS[i]:
+                i += 1
+            counts[i] += 1
+        labels = ["<=" + str(b) + "ms" for b in HISTOGRAM_BUCKETS] + [">" + str(HISTOGRAM_BUCKETS[-1]) + "ms"]
+        return dict(zip(labels, counts))
+
+    def to_dict(self, duration):
+        latencies = sorted(self.latencies)
+        return {
+            "route": self.name,
+            "requests": self.requests,
+            "errors": self.errors,
+            "error-rate": self.errors / self.requests if self.requests > 0 else 0,
+            "throughput": self.requests / duration if duration > 0 else 0,
+            "latency": {
+                "p50": percentile(latencies, 50),
+                "p90": percentile(latencies, 90),
+                "p99": percentile(latencies, 99),
+                "max": latencies[-1] if len(latencies) > 0 else None,
+            },
+            "histogram": self.histogram(),
+        }
+
+
+class LoadReport:
+    def __init__(self, name, users, rate, duration):
+        self.name = name
+        self.title = name
+        self.users = users
+        self.rate = rate
+        self.duration = duration
+        self.iterations = 0
+        self.failed_iterations = 0
+        self.routes = {}
+
+    @property
+    def requests(self):
+        return sum(stats.requests for stats in self.routes.values())
+
+    @property
+    def errors(self):
+        return sum(stats.errors for stats in self.routes.values())
+
+    @property
+    def success(self):
+        return self.errors == 0 and self.failed_iterations == 0
+
+    def add(self, results):
+        self.iterations += 1
+        for result in results:
+            key = route_name(result.route)
+            if key not in self.routes:
+                self.routes[key] = RouteStats(key)
+            self.routes[key].add(result)
+
+    def to_dict(self):
+        return {
+            "success": self.success,
+            "title": self.title,
+            "users": self.users,
+            "rate": self.rate,
+            "duration": self.duration,
+            "iterations": self.iterations,
+            "failed-iterations": self.failed_iterations,
+            "requests": self.requests,
+            "errors": self.errors,
+            "throughput": self.requests / self.duration if self.duration > 0 else 0,
+            "routes": [stats.to_dict(self.duration) for stats in self.routes.values()],
+        }
+
+    def write(self, stream, verbosity=0, indent=0):
+        d = self.to_dict()
+        stream.write(" " * indent + f"{d['requests']} requests in {d['duration']:.2f}s "
+                                    f"({d['throughput']:.1f} req/s, {d['users']} users), {d['errors']} errors\n")
+        if self.failed_iterations > 0:
+            stream.write(" " * indent + f"{self.failed_iterations} iterations raised an exception\n")
+        stream.write(" " * indent + "{:>8} {:>7} {:>7} {:>8} {:>8} {:>8} {:>8}  {}\n".format(
+            "requests", "errors", "err%", "p50 ms", "p90 ms", "p99 ms", "max ms", "route"))
+        for r in d["routes"]:
+            latency = [format_ms(r["latency"][p]) for p in ("p50", "p90", "p99", "max")]
+            stream.write(" " * indent + "{:>8} {:>7} {:>7.1%} {:>8} {:>8} {:>8} {:>8}  {}\n".format(
+                r["requests"], r["errors"], r["error-rate"], *latency, r["route"]))
+            if verbosity >= 1:
+                for label, count in r["histogram"].items():
+                    if count > 0:
+                        stream.write(" " * (indent + 10) + "{:>9} {}\n".format(label, count))
+        stream.flush()
+
+
+def format_ms(seconds):
+    return "-" if seconds is None else "{:.1f}".format(seconds * 1000)
+
+
+def route_name(route):
+    name = route.method + " " + route.path
+    if route.doc is not None:
+        name += " (" + route.doc + ")"
+    return name
+
+
+def virtual_user(test, args, config, limiter, deadline, report, lock):
+    with task_context(test):
+        run_virtual_user(test, args, config, limiter, deadline, report, lock)
+
+
+def session_options(options):
+    """The options of a virtual user's session. An HTTP cache would measure its hits instead of the server."""
+    return {k: v for k, v in options.items() if k != 'cache'}
+
+
+def run_virtual_user(test, args, config, limiter, deadline, report, lock):
+    session = create_session(session_options(config['options']))
+    if limiter is not None:
+        session = PacedSession(session, limiter)
+
+    paced_iterations = None
+    if isinstance(test, HttpRoutesWrapper):
+        routes = filter_routes(args.get('route'), config['routes'])
+        hosts = filter_hosts(args.get('host'), config['hosts'])
+        iteration = lambda: handle_routes(session, hosts, routes, workers=1)
+    else:
+        kwargs = filter_args(args, test.args)
+        if 'session' in test.args:
+            kwargs['session'] = session
+        else:
+            # the test creates its own session, so only whole iterations can be paced
+            paced_iterations = limiter
+        iteration = lambda: test(**kwargs)
+
+    while time.monotonic() < deadline:
+        if paced_iterations is not None:
+            paced_iterations.wait()
+        try:
+            results = list(iteration())
+        except Exception:
+            with lock:
+                report.failed_iterations += 1
+            continue
+        with lock:
+            report.add(results)
+
+
+def load(tests, function_name, args=None, command_args=None, config=None):
+    """Replays the routes of a test with several virtual users for a given duration"""
+    args = args if args is not None else {}
+    command_args = command_args if command_args is not None else {}
+    fn = name_to_python(function_name)
+    if fn not in tasks:
+        raise ValueError(f"Test '{function_name}' not found")
+    if not isinstance(tasks[fn], (HttpWrapper, HttpRoutesWrapper)):
+        raise ValueError(f"Test '{function_name}' is not an http test")
+    if config is None:
+        with task_context(tasks[fn]):
+            config = http.current_config()
+    users = int(command_args.get('c', 1))
+    rate = float(command_args['rps']) if 'rps' in command_args else None
+    duration = float(command_args.get('d', 10))
+
+    limiter = RateLimiter(rate) if rate is not None else None
+    report = LoadReport(function_name, users, rate, duration)
+    lock = threading.Lock()
+    start = time.monotonic()
+    deadline = start + duration
+    threads = [threading.Thread(target=virtual_user, args=(tasks[fn], args, config, limiter, deadline, report, lock))
+               for _ in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report.duration = time.monotonic() - start
+    return report
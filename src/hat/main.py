@@ -1,11 +1,135 @@
 import sys
+import contextvars
+import copy
+import hashlib
 import importlib.machinery
 import importlib.util
+import os
+import pickle
+import threading
+import time
 import traceback
+import types
 import io
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager, nullcontext
 
 tasks = {}
 IGNORE_BUILTIN = "IGNORE_BUILTIN"
+NAMESPACE_SEPARATOR = ":"
+
+_hatfile = contextvars.ContextVar('hatfile', default=None)
+# tests running at the same time, they share the threads of the `parallel` option
+_test_workers = contextvars.ContextVar('test_workers', default=1)
+
+
+class HatFile:
+    """A hatfile loaded together with others. Its tests are registered with the namespace as prefix and its
+    HOSTS, ROUTES and OPTIONS go to its own config, which is active while one of its tests runs."""
+    def __init__(self, file, namespace="", config=None):
+        self.file = file
+        self.namespace = namespace
+        self.config = config
+        self.module = None
+
+    def qualify(self, name):
+        if self.namespace == "" or NAMESPACE_SEPARATOR in name:
+            return name
+        return self.namespace + NAMESPACE_SEPARATOR + name
+
+    @contextmanager
+    def activate(self):
+        token = _hatfile.set(self)
+        try:
+            yield self
+        finally:
+            _hatfile.reset(token)
+
+
+class Suite:
+    """The hatfiles of one invocation, loaded into the same process"""
+    def __init__(self, paths, hatfiles):
+        self.paths = paths
+        self.hatfiles = hatfiles
+
+
+def current_hatfile():
+    return _hatfile.get()
+
+
+def task_context(task):
+    return task.hatfile.activate() if task.hatfile is not None else nullcontext()
+
+
+def register(task):
+    """Adds a decorated test to the tasks. Tests of a hatfile which is loaded by load_suite get its namespace,
+    tests defined elsewhere (like the builtin ones) join every hatfile which imports them."""
+    hatfile = current_hatfile()
+    if hatfile is not None and hatfile.module is not None and task.func.__module__ == hatfile.module.__name__:
+        task.hatfile = hatfile
+        task.name = hatfile.qualify(task.name)
+        task.depends = [hatfile.qualify(d) for d in task.depends]
+    elif hatfile is not None:
+        return
+    tasks[task.name] = task
+
+
+def adopt_shared_tasks(hatfile):
+    for value in list(vars(hatfile.module).values()):
+        task = getattr(value, 'hat_task', None)
+        if task is None or task.hatfile is hatfile or not isinstance(task, TestWrapper):
+            continue
+        clone = copy.copy(task)
+        clone.hatfile = hatfile
+        clone.name = hatfile.qualify(task.name.split(NAMESPACE_SEPARATOR)[-1])
+        clone.depends = [hatfile.qualify(d) for d in task.depends]
+        tasks[clone.name] = clone
+
+
+class OutputRouter:
+    """Sends writes of threads which capture their output to their own buffer, everything else to the real stream."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.users = 0
+
+    def target(self):
+        buffer = getattr(self.local, 'buffer', None)
+        return buffer if buffer is not None else self.stream
+
+    def write(self, s):
+        return self.target().write(s)
+
+    def writelines(self, lines):
+        return self.target().writelines(lines)
+
+    def flush(self):
+        return self.target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+_router_lock = threading.Lock()
+
+
+@contextmanager
+def capture_output():
+    with _router_lock:
+        if not isinstance(sys.stdout, OutputRouter):
+            sys.stdout = OutputRouter(sys.stdout)
+        router = sys.stdout
+        router.users += 1
+    buffer = io.StringIO()
+    router.local.buffer = buffer
+    try:
+        yield buffer
+    finally:
+        router.local.buffer = None
+        with _router_lock:
+            router.users -= 1
+            if router.users == 0 and sys.stdout is router:
+                sys.stdout = router.stream
 
 
 class TestWrapper:
@@ -14,6 +138,10 @@ class TestWrapper:
         self.args = []
         self.func = None
         self.builtin = False
+        self.depends = []
+        self.hatfile = None
+        # tests which split their own work when sharded run on every shard
+        self.shards_itself = False
 
     def __call__(self, *args, **kwargs):
         return self.func(*args, **kwargs)
@@ -30,9 +158,80 @@ class TestWrapper:
         doc = self.func.__doc__.split("\n") if self.func.__doc__ is not None else []
         for d in doc:
             result.append("  " + d)
+        if len(self.depends) > 0:
+            result.append("  depends on: " + ", ".join(python_to_name(d) for d in self.depends))
 
         return result
 
+    def fingerprint(self):
+        """Changes when the definition of the test changes, used to rerun only the changed tests"""
+        digest = hashlib.sha256()
+        digest.update(repr((self.name, self.args, self.depends, self.builtin)).encode("utf-8"))
+        if self.func is not None:
+            code_digest(self.func.__code__, digest)
+            digest.update(repr(self.func.__defaults__).encode("utf-8"))
+            try:
+                globals_digest(self.func, digest)
+            except Exception:
+                # a global which can't be compared counts as changed every time
+                return None
+        return digest.hexdigest()
+
+    def dependency_args(self, dependencies):
+        """Arguments passed from the finished dependencies: their results by name and their merged storage"""
+        kwargs = {}
+        storage = {}
+        for name, dependency in dependencies.items():
+            kwargs[name] = dependency.result[1]
+            storage.update(dependency.kwargs.get('storage') or {})
+        kwargs['storage'] = storage
+        return filter_args(kwargs, self.args)
+
+
+def code_digest(code, digest):
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode("utf-8"))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            code_digest(const, digest)
+        else:
+            digest.update(repr(const).encode("utf-8"))
+
+
+def code_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= code_names(const)
+    return names
+
+
+def globals_digest(func, digest, seen=None):
+    """Adds the module level values func uses, like lists of routes, and the code of the functions of its module
+    it calls"""
+    seen = set() if seen is None else seen
+    for name in sorted(code_names(func.__code__)):
+        if name in seen or name not in func.__globals__:
+            continue
+        seen.add(name)
+        value = func.__globals__[name]
+        if isinstance(value, types.FunctionType):
+            if value.__module__ == func.__module__:
+                digest.update(name.encode("utf-8"))
+                code_digest(value.__code__, digest)
+                globals_digest(value, digest, seen)
+        elif not isinstance(value, (types.ModuleType, type)) and not callable(value):
+            digest.update(name.encode("utf-8"))
+            digest.update(pickle.dumps(value))
+
+
+class TestState:
+    def __init__(self, result, kwargs, duration=None):
+        self.result = result
+        self.kwargs = kwargs
+        self.duration = duration
+        self.success = is_success(result)
+
 
 def filter_args(args, params):
     result = {}
@@ -48,7 +247,12 @@ def get_ignore_builtin(tests):
     return False
 
 
-def setup(tests):
+def setup(tests, command_args=None):
+    if isinstance(tests, Suite):
+        for hatfile in tests.hatfiles:
+            with hatfile.activate():
+                setup(hatfile.module, command_args)
+        return
     if hasattr(tests, "CONFIG"):
         from hat.http import set_config
         set_config(tests.CONFIG)
@@ -61,87 +265,398 @@ def setup(tests):
     if hasattr(tests, "OPTIONS"):
         from hat.http import set_options
         set_options(tests.OPTIONS)
+    if command_args is not None and 'p' in command_args:
+        from hat.http import set_options
+        set_options({"parallel": int(command_args['p'])})
+    if command_args is not None and 'profile' in command_args:
+        # the routes of a test run on other threads with `parallel`, which its profiler wouldn't see
+        from hat.http import set_options
+        set_options({"parallel": 1})
+    if command_args is not None and 'http_cache' in command_args:
+        from hat.http import set_options
+        set_options({"cache": "run" if command_args['http_cache'] is True else command_args['http_cache']})
+    for option in ('shard', 'record', 'replay'):
+        if command_args is not None and option in command_args:
+            from hat.http import set_options
+            set_options({option: command_args[option]})
+
+
+def is_success(result):
+    return result[1].success if hasattr(result[1], 'success') else bool(result[1])
 
 
-def run(tests, function_name, args=None, command_args=None):
-    ignore_builtin = get_ignore_builtin(tests)
-    stdout = sys.stdout
+def profile_context(name, command_args):
+    if command_args is None or 'profile' not in command_args:
+        return nullcontext()
+    from .profiler import profiled, profile_directory
+    return profiled(name, profile_directory(command_args))
+
+
+def run(tests, function_name, args=None, command_args=None, injected=None):
     fn = name_to_python(function_name)
-    if fn in tasks:
-        sys.stdout = io.StringIO()
+    if fn not in tasks:
+        return [[f"Test '{function_name}' not found"], False]
+
+    kwargs = filter_args(args, tasks[fn].args)
+    if injected is not None:
+        kwargs.update(injected)
+    with capture_output() as captured, task_context(tasks[fn]), profile_context(fn, command_args) as profile:
         try:
-            success = tasks[fn](**filter_args(args, tasks[fn].args))
+            success = tasks[fn](**kwargs)
+            if profile is not None:
+                profile.result = success
         except:
-            success = False
-            output = sys.stdout.getvalue()
-            sys.stdout = stdout
-            output += traceback.format_exc()
+            output = captured.getvalue() + traceback.format_exc()
             output_lines = output.split("\n")
-            result = [[function_name + ": "] + output_lines, success]
-            return result
-        if hasattr(success, 'write') and hasattr(success, 'title') and hasattr(success, 'success'):
-            output = sys.stdout.getvalue()
-            sys.stdout = stdout
-            if output.strip() != '':
-                output_lines = output.split("\n")
-            else:
-                output_lines = []
-            result = [output_lines, success]
-        else:
-            output = sys.stdout.getvalue()
-            sys.stdout = stdout
-            if output.strip() != '':
-                output_lines = output.split("\n")
-            else:
-                output_lines = []
-            result = [[function_name + ": "] + output_lines, success]
+            return [[function_name + ": "] + output_lines, False]
+        output = captured.getvalue()
+
+    if output.strip() != '':
+        output_lines = output.split("\n")
     else:
-        result = [[f"Test '{function_name}' not found"], False]
-    return result
+        output_lines = []
+    if hasattr(success, 'write') and hasattr(success, 'title') and hasattr(success, 'success'):
+        return [output_lines, success]
+    return [[function_name + ": "] + output_lines, success]
+
+
+def timed_run(tests, function_name, args=None, command_args=None, injected=None):
+    start = time.perf_counter()
+    result = run(tests, function_name, args, command_args, injected)
+    return result, time.perf_counter() - start
+
 
+def host_workers(parallel):
+    """Threads for the hosts of the running test: -p=8 runs 8 tests at a time with one host thread each instead of
+    8 threads each"""
+    return max(1, parallel // _test_workers.get())
 
-def runall(tests, args=None, command_args=None):
+
+def timed_run_among(test_workers, *args):
+    _test_workers.set(test_workers)
+    return timed_run(*args)
+
+
+class Scheduler:
+    """Runs tests after the tests they depend on. Every test runs once, independent tests run in parallel."""
+    def __init__(self, tests, args=None, command_args=None, workers=1, records=None):
+        self.tests = tests
+        self.args = args
+        self.command_args = command_args
+        self.workers = workers
+        # (name, success, duration) of every finished test, if a list is given
+        self.records = records
+
+    def collect(self, names):
+        result = []
+        todo = [name_to_python(name) for name in names]
+        while len(todo) > 0:
+            name = todo.pop(0)
+            if name in result:
+                continue
+            result.append(name)
+            if name in tasks:
+                todo += tasks[name].depends
+        return result
+
+    def run(self, names):
+        names = self.collect(names)
+        pending = {name: set(tasks[name].depends) if name in tasks else set() for name in names}
+        dependents = {name: [] for name in names}
+        for name in names:
+            for dependency in pending[name]:
+                if dependency in dependents:
+                    dependents[dependency].append(name)
+        states = {}
+        ready = [name for name in names if len(pending[name]) == 0]
+        running = {}
+        executor = ThreadPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+
+        try:
+            while len(ready) > 0 or len(running) > 0:
+                finished = []
+                while len(ready) > 0:
+                    name = ready.pop(0)
+                    if name not in tasks:
+                        finished.append((name, TestState(run(self.tests, name), {})))
+                        continue
+                    failed = [d for d in tasks[name].depends if not states[d].success]
+                    if len(failed) > 0:
+                        message = f"Skipped, dependency '{python_to_name(failed[0])}' failed"
+                        finished.append((name, TestState([[name + ": ", message], False], {})))
+                        continue
+                    injected = self.injected(name, states, dependents[name])
+                    if executor is None:
+                        result, duration = timed_run(self.tests, name, self.args, self.command_args, injected)
+                        finished.append((name, TestState(result, injected, duration)))
+                        break
+                    future = executor.submit(timed_run_among, min(self.workers, len(names)), self.tests, name,
+                                             self.args, self.command_args, injected)
+                    running[future] = (name, injected)
+                if len(finished) == 0:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name, injected = running.pop(future)
+                        result, duration = future.result()
+                        finished.append((name, TestState(result, injected, duration)))
+
+                for name, state in finished:
+                    states[name] = state
+                    if self.records is not None:
+                        self.records.append((name, state.success, state.duration))
+                    yield state.result
+                    for dependent in dependents[name]:
+                        pending[dependent].discard(name)
+                        if len(pending[dependent]) == 0:
+                            ready.append(dependent)
+                ready.sort(key=names.index)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        for name in names:
+            if name not in states:
+                yield [[name + ": ", "Skipped, circular dependency"], False]
+
+    def injected(self, name, states, dependents):
+        test = tasks[name]
+        dependencies = {d: states[d] for d in test.depends}
+        if len(dependencies) == 0 and len(dependents) == 0:
+            return None
+        with task_context(test):
+            return test.dependency_args(dependencies)
+
+    def components(self, names):
+        names = self.collect(names)
+        components = []
+        for name in names:
+            related = {name} | set(tasks[name].depends if name in tasks else [])
+            joined = [c for c in components if len(c & related) > 0]
+            for c in joined:
+                components.remove(c)
+                related |= c
+            components.append(related)
+        return [sorted(c, key=names.index) for c in sorted(components, key=lambda c: min(map(names.index, c)))]
+
+
+_worker_tests = None
+
+
+def _init_worker(paths, command_args):
+    global _worker_tests
+    _test_workers.set(get_workers(command_args))
+    # forked workers inherit the already loaded tests
+    if len(tasks) == 0:
+        _worker_tests = load_suite(paths)
+        setup(_worker_tests, command_args)
+
+
+def _run_in_worker(names, args, command_args):
+    from .cassette import save_cassettes
+    records = []
+    results = list(Scheduler(_worker_tests, args, command_args, records=records).run(names))
+    # atexit handlers don't run in the workers of a process pool
+    save_cassettes()
+    return results, records
+
+
+def get_workers(command_args):
+    if command_args is None or 'p' not in command_args:
+        return 1
+    return max(int(command_args['p']), 1)
+
+
+def run_tests(tests, names, args=None, command_args=None, records=None):
+    workers = get_workers(command_args)
+    pool = command_args.get('pool', 'thread') if command_args is not None else 'thread'
+    if 'profile' in (command_args or {}):
+        # a profiler only sees its own thread, tests running next to each other would blur the wall times, and the
+        # profiles of a process pool would stay in its workers
+        workers = 1
+    scheduler = Scheduler(tests, args, command_args, workers, records)
+    if workers <= 1 or pool == 'thread':
+        yield from scheduler.run(names)
+    elif pool == 'process':
+        # tests sharing dependencies have to share a process
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(suite_paths(tests), command_args)) as executor:
+            futures = [executor.submit(_run_in_worker, component, args, command_args)
+                       for component in scheduler.components(names)]
+            while len(futures) > 0:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in futures[:]:
+                    if future in done:
+                        futures.remove(future)
+                        results, worker_records = future.result()
+                        if records is not None:
+                            records += worker_records
+                        yield from results
+    else:
+        raise ValueError(f"Unknown pool: '{pool}'")
+
+
+def task_ignores_builtin(tests, task):
+    return get_ignore_builtin(task.hatfile.module if task.hatfile is not None else tests)
+
+
+def shard_names(names, shard, durations=None):
+    """The tests of names which run on the shard (i, n). Tests depending on each other stay on the same shard,
+    the groups are balanced by their durations of the last run. Every shard has to use the same durations, the
+    order of names doesn't matter."""
+    from .shard import select
+    durations = durations if durations is not None else {}
+    known = [durations[n] for n in names if n in durations]
+    default = sum(known) / len(known) if len(known) > 0 else 1.0
+    everywhere = [n for n in names if n in tasks and tasks[n].shards_itself]
+    components = Scheduler(None).components(sorted(n for n in names if n not in everywhere))
+    weights = [sum(durations.get(n, default) for n in component) for component in components]
+    selected = {n for component in select(components, weights, shard) for n in component}
+    return [n for n in names if n in selected or n in everywhere]
+
+
+def runall_names(tests):
+    return [k for k, v in tasks.items() if not (v.builtin and task_ignores_builtin(tests, v))]
+
+
+def runall(tests, args=None, command_args=None, records=None, names=None):
+    if names is None:
+        names = runall_names(tests)
+    yield from run_tests(tests, names, args, command_args, records)
+
+
+def describe(tests):
+    """Everything `hat list` shows about the loaded tests, in a form which can be cached"""
+    description = {"ignore_builtin": bool(get_ignore_builtin(tests)), "tests": {}}
     for k, v in tasks.items():
-        name = k
-        if v.builtin and get_ignore_builtin(tests):
-            continue
-        yield run(tests, name, args, command_args)
+        with task_context(v):
+            description["tests"][k] = {
+                "args": v.args,
+                "builtin": v.builtin,
+                "ignore_builtin": bool(task_ignores_builtin(tests, v)),
+                "depends": v.depends,
+                "short_help": v.short_help(),
+                "long_help": v.long_help(),
+            }
+    return description
 
 
-def list_tests(tests, what=None, command_args=None):
+def list_tests(tests, what=None, command_args=None, description=None):
     verbose = True if 'v' in command_args else False
+    if description is None:
+        description = describe(tests)
+    help = "long_help" if verbose else "short_help"
 
     result = []
     if what is None:
-        for k, v in tasks.items():
-            name = python_to_name(k)
-            if v.builtin and get_ignore_builtin(tests):
+        for k, v in description["tests"].items():
+            if v["builtin"] and v.get("ignore_builtin", description["ignore_builtin"]):
                 continue
-            if verbose:
-                result += v.long_help()
-            else:
-                result += v.short_help()
+            result += v[help]
     else:
         name = name_to_python(what)
-        if name in tasks:
-            if verbose:
-                result += tasks[name].long_help()
-            else:
-                result += tasks[name].short_help()
+        if name in description["tests"]:
+            result += description["tests"][name][help]
         else:
            result += [f"Test not found: '{what}'"]
 
     return result
 
 
-def import_tests(module, file):
+def import_tests(module, file, hatfile=None):
     loader = importlib.machinery.SourceFileLoader(module, file)
     spec = importlib.util.spec_from_loader(module, loader)
     tests = importlib.util.module_from_spec(spec)
-    loader.exec_module(tests)
+    if hatfile is None:
+        loader.exec_module(tests)
+        return tests
+    hatfile.module = tests
+    with hatfile.activate():
+        loader.exec_module(tests)
+    adopt_shared_tasks(hatfile)
     return tests
 
 
+HATFILE_NAME = "hatfile.py"
+HATFILE_SUFFIX = "_hatfile.py"
+
+
+def is_hatfile(name):
+    return name == HATFILE_NAME or name.endswith(HATFILE_SUFFIX)
+
+
+def find_hatfiles(paths):
+    """The hatfiles of the given files and directories. Directories are searched recursively for `hatfile.py`
+    and `*_hatfile.py` files."""
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(os.path.abspath(path))
+            continue
+        for root, dirs, names in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith(".") and d != "__pycache__")
+            files += [os.path.abspath(os.path.join(root, name)) for name in sorted(names) if is_hatfile(name)]
+    return list(dict.fromkeys(files))
+
+
+def hatfile_namespace(file, root):
+    parts = os.path.relpath(file, root).split(os.sep)
+    if parts[-1] == HATFILE_NAME:
+        parts = parts[:-1] if len(parts) > 1 else [os.path.basename(root)]
+    elif parts[-1].endswith(HATFILE_SUFFIX):
+        parts[-1] = parts[-1][:-len(HATFILE_SUFFIX)]
+    else:
+        parts[-1] = os.path.splitext(parts[-1])[0]
+    return name_to_python(".".join(parts))
+
+
+def load_suite(paths):
+    """Loads the hatfiles of the given files and directories into this process. A single hatfile is loaded as
+    before, several hatfiles get a namespace and a config each. Modules imported by the hatfiles are shared."""
+    files = find_hatfiles(paths)
+    if len(files) == 0:
+        raise ValueError("No hatfiles found in: " + ", ".join(paths))
+    if len(files) == 1:
+        return import_tests('hatfile', files[0])
+
+    from hat.http import new_config
+    root = os.path.commonpath([os.path.dirname(f) for f in files])
+    hatfiles = []
+    for file in files:
+        hatfile = HatFile(file, hatfile_namespace(file, root), new_config())
+        for other in hatfiles:
+            if other.namespace == hatfile.namespace:
+                raise ValueError(f"Hatfiles '{other.file}' and '{file}' share the namespace '{hatfile.namespace}'")
+        import_tests("hatfile_" + hatfile.namespace.replace(".", "_"), file, hatfile)
+        hatfiles.append(hatfile)
+    return Suite(paths, hatfiles)
+
+
+def task_file(task):
+    """The file of the module which defined the task, None for hatfiles, which aren't in sys.modules"""
+    module = sys.modules.get(getattr(getattr(task, 'func', None), '__module__', None))
+    file = getattr(module, '__file__', None)
+    return os.path.abspath(file) if file is not None else None
+
+
+def reload_suite(paths):
+    """Forgets the loaded tests and their configs and loads the hatfiles again. Tasks of modules the hatfiles
+    import, like the builtin test_routes, are registered once on import, so they are kept."""
+    from hat.http import reset_config
+    hatfiles = set(find_hatfiles(paths))
+    shared = {name: task for name, task in tasks.items()
+              if task.hatfile is None and task_file(task) is not None and task_file(task) not in hatfiles}
+    tasks.clear()
+    tasks.update(shared)
+    reset_config()
+    return load_suite(paths)
+
+
+def suite_paths(tests):
+    if isinstance(tests, Suite):
+        return tests.paths
+    return [tests.__file__]
+
+
 def python_to_name(name):
     return name.replace("_", "-")
 
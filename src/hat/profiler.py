@@ -0,0 +1,114 @@
+import cProfile
+import os
+import pstats
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_DIRECTORY = "hat-profile"
+HAT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+NETWORK_MODULES = ("requests", "urllib3", "http", "socket", "ssl", "asyncio", "selectors")
+
+
+def profile_directory(command_args):
+    value = command_args.get('profile') if command_args is not None else None
+    return DEFAULT_DIRECTORY if value is True else value
+
+
+def profile_path(directory, name):
+    return os.path.join(directory, re.sub(r"[^\w.-]", "_", name) + ".prof")
+
+
+def network_time(result):
+    """Seconds the routes of a test result spent on requests, by the timings hat measured for them"""
+    timing = getattr(result, 'timing', None)
+    if callable(timing):
+        timing = timing()
+    elif timing is not None:
+        timing = timing.to_dict()
+    if timing is None:
+        return 0.0
+    return timing.get("total") or 0.0
+
+
+def _module_group(file, function):
+    if file.startswith(HAT_DIRECTORY + os.sep):
+        return "hat"
+    if file == "~":
+        # builtins like the recv of a socket
+        return "http" if re.search(r"\b_?(socket|ssl|select|selectors|poll|epoll)\b", function) else "other"
+    parts = file.replace("\\", "/").split("/")
+    if any(part in NETWORK_MODULES or part.split(".")[0] in NETWORK_MODULES for part in parts[-2:]):
+        return "http"
+    return "other"
+
+
+def breakdown(stats):
+    """CPU time of the profiled functions, split into hat itself, the http libraries and everything else"""
+    groups = {"hat": 0.0, "http": 0.0, "other": 0.0}
+    for (file, _, function), (_, _, tottime, _, _) in stats.stats.items():
+        groups[_module_group(file, function)] += tottime
+    return groups
+
+
+class TestProfile:
+    """Wall, network and CPU time of a test. The test sets result, the network time is taken from its timings."""
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.result = None
+        self.wall = None
+        self.network = None
+        self.groups = None
+
+    def finish(self, profiler, wall):
+        self.wall = wall
+        self.network = network_time(self.result)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        profiler.dump_stats(self.path)
+        self.groups = breakdown(pstats.Stats(profiler))
+
+    def __str__(self):
+        return (f"{self.wall:8.3f}s wall {self.network:8.3f}s network {self.groups['hat']:8.3f}s hat "
+                f"{self.groups['http']:8.3f}s http libraries {self.groups['other']:8.3f}s other  {self.name}")
+
+
+_profiles = []
+_profiles_lock = threading.Lock()
+
+
+@contextmanager
+def profiled(name, directory):
+    """Profiles the thread of a test and writes the profile to the directory"""
+    profile = TestProfile(name, profile_path(directory, name))
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        yield profile
+    finally:
+        profiler.disable()
+        profile.finish(profiler, time.perf_counter() - start)
+        with _profiles_lock:
+            _profiles.append(profile)
+
+
+def profiles():
+    with _profiles_lock:
+        return list(_profiles)
+
+
+def hot_functions(profiles, n):
+    """The n functions with the most own time over all profiles, as (time, calls, location)"""
+    if len(profiles) == 0:
+        return []
+    stats = pstats.Stats(*[p.path for p in profiles])
+    functions = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:n]
+    return [(tottime, calls, f"{_location(file)}:{line}({function})")
+            for (file, line, function), (_, calls, tottime, _, _) in functions]
+
+
+def _location(file):
+    cwd = os.getcwd()
+    return os.path.relpath(file, cwd) if file.startswith(cwd + os.sep) else file
@@ -0,0 +1,201 @@
+import json
+import random
+import re
+import string
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+from .http import current_config, Template, JSON
+from .main import Suite
+
+
+def suite_routes(tests):
+    """The ROUTES of all loaded hatfiles"""
+    if isinstance(tests, Suite):
+        routes = []
+        for hatfile in tests.hatfiles:
+            with hatfile.activate():
+                routes += current_config()['routes']
+        return routes
+    return list(current_config()['routes'])
+
+
+def path_pattern(path):
+    """A regex for the path of a route, placeholders match one path segment. Returns the pattern and the names of
+    its groups."""
+    pattern = ""
+    names = []
+    for literal, field, _, _ in string.Formatter().parse(path.split("?", 1)[0]):
+        pattern += re.escape(literal)
+        if field is not None:
+            names.append(field.split(".")[0].split("[")[0])
+            pattern += f"(?P<g{len(names) - 1}>[^/]+)"
+    return re.compile(pattern.rstrip("/") + "/?$"), names
+
+
+def parse_latency(text):
+    """`seconds` or `min-max` seconds, returned as (min, max)"""
+    try:
+        parts = [float(part) for part in str(text).split("-", 1)]
+    except ValueError:
+        raise ValueError(f"Invalid latency: '{text}', expected seconds or min-max")
+    low, high = parts[0], parts[-1]
+    if low < 0 or high < low:
+        raise ValueError(f"Invalid latency: '{text}', expected 0 <= min <= max")
+    return low, high
+
+
+class MockRoute:
+    def __init__(self, route):
+        self.route = route
+        self.method = route.method.upper()
+        self.pattern, self.names = path_pattern(route.path)
+        response = route.response
+        self.code = response.code
+        self.reason = response.status
+        self.headers = {k: Template(v) for k, v in (response.headers or {}).items()}
+        self.fields = set(response.fields()) | set().union(*[t.fields for t in self.headers.values()])
+        if isinstance(response.body, dict) or isinstance(response.body, list):
+            self.body = JSON(response.body)
+            self.fields |= self.body.fields()
+        elif response.body is not None:
+            self.body = Template(str(response.body))
+            self.fields |= self.body.fields
+        else:
+            self.body = None
+
+    def match(self, method, path):
+        if method != self.method:
+            return None
+        m = self.pattern.match(path)
+        if m is None:
+            return None
+        return {name: m.group(f"g{i}") for i, name in enumerate(self.names)}
+
+    def render(self, values):
+        """Status, reason, headers and body of the response. Placeholders nobody provided render as their name, or
+        as 0 where the name doesn't fit, like in ToInt."""
+        try:
+            return self._render(dict({f: f for f in self.fields if f != ""}, **values))
+        except ValueError:
+            return self._render(dict({f: "0" for f in self.fields if f != ""}, **values))
+
+    def _render(self, values):
+        headers = {k: t.render(values) for k, t in self.headers.items()}
+        body = b""
+        if self.body is not None:
+            body = self.body.render(values).encode("utf-8")
+            if isinstance(self.body, JSON):
+                headers.setdefault("Content-Type", "application/json")
+        return self.code, self.reason, headers, body
+
+
+def request_values(query, body):
+    """Values for the placeholders of a response: the query parameters and the top level fields of a JSON body"""
+    values = dict(parse_qsl(query))
+    try:
+        data = json.loads(body) if len(body) > 0 else None
+    except ValueError:
+        data = None
+    if isinstance(data, dict):
+        values.update({k: str(v) if not isinstance(v, str) else v for k, v in data.items()
+                       if not isinstance(v, (dict, list))})
+    return values
+
+
+class MockServer:
+    """Answers the requests of hat with the responses the routes expect. Routes with the same method and path are
+    answered in turn, so a suite runs through its routes like against the real service."""
+    def __init__(self, routes, latency=(0.0, 0.0), error_rate=0.0, error_status=500, seed=None):
+        self.routes = [MockRoute(route) for route in routes]
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.turns = {}
+        self.lock = threading.Lock()
+
+    def respond(self, method, target, body):
+        parts = urlsplit(target)
+        matches = [(i, values) for i, values in enumerate(r.match(method, parts.path) for r in self.routes)
+                   if values is not None]
+        key = tuple(i for i, _ in matches)
+        with self.lock:
+            delay = self.random.uniform(*self.latency) if self.latency[1] > 0 else 0
+            error = self.error_rate > 0 and self.random.random() < self.error_rate
+            turn = self.turns.get(key, 0)
+            self.turns[key] = turn + 1
+        if delay > 0:
+            time.sleep(delay)
+        if error:
+            return self.error_status, None, {"Content-Type": "application/json"}, b'{"error": "injected"}'
+        if len(matches) == 0:
+            message = json.dumps({"error": f"No route for {method} {parts.path}"})
+            return 404, None, {"Content-Type": "application/json"}, message.encode("utf-8")
+        index, values = matches[turn % len(matches)]
+        route = self.routes[index]
+        try:
+            return route.render(dict(request_values(parts.query, body), **values))
+        except (KeyError, IndexError, ValueError, TypeError) as e:
+            message = json.dumps({"error": f"Can't render the response of {route.route}: {e!r}"})
+            return 500, None, {"Content-Type": "application/json"}, message.encode("utf-8")
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def handle_request(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length > 0 else b""
+                code, reason, headers, content = server.respond(self.command, self.path, body)
+                self.send_response(code, reason)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(content)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_HEAD = do_OPTIONS = handle_request
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def create(self, host="127.0.0.1", port=8080):
+        httpd = ThreadingHTTPServer((host, port), self.handler())
+        httpd.daemon_threads = True
+        return httpd
+
+
+def serve(tests, command_args):
+    routes = suite_routes(tests)
+    if len(routes) == 0:
+        print("No routes found.")
+        return 1
+    try:
+        latency = parse_latency(command_args.get('latency', 0))
+        error_rate = float(command_args.get('error_rate', 0))
+        error_status = int(command_args.get('error_status', 500))
+        seed = int(command_args['seed']) if 'seed' in command_args else None
+        port = int(command_args.get('port', 8080))
+    except ValueError as e:
+        print(str(e))
+        return 1
+    server = MockServer(routes, latency, error_rate, error_status, seed)
+    httpd = server.create(command_args.get('bind', "127.0.0.1"), port)
+    sys.stderr.write("Serving {} routes on http://{}:{}/\n".format(len(routes), *httpd.server_address[:2]))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+    return 0
@@ -0,0 +1,77 @@
+import json
+
+
+def parse_shard(text):
+    """`i/n` with 1 <= i <= n, returned as (i, n)"""
+    try:
+        index, count = (int(part) for part in str(text).split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid shard: '{text}', expected i/n")
+    if count < 1 or index < 1 or index > count:
+        raise ValueError(f"Invalid shard: '{text}', expected 1 <= i <= n")
+    return index, count
+
+
+def assign(weights, count):
+    """Distributes units with the given weights on count shards, heaviest first to the least loaded shard.
+    The result only depends on the weights and their order, so every shard computes the same distribution."""
+    loads = [0.0] * count
+    shards = [None] * len(weights)
+    for unit in sorted(range(len(weights)), key=lambda u: (-weights[u], u)):
+        shard = min(range(count), key=lambda s: (loads[s], s))
+        shards[unit] = shard
+        loads[shard] += weights[unit]
+    return shards
+
+
+def select(units, weights, shard):
+    index, count = shard
+    return [unit for unit, s in zip(units, assign(weights, count)) if s == index - 1]
+
+
+def merge_timing(timings):
+    timings = [t for t in timings if t is not None]
+    if len(timings) == 0:
+        return None
+    result = {}
+    for key in timings[0]:
+        if key == "max":
+            values = [t[key] for t in timings if t.get(key) is not None]
+            result[key] = max(values) if len(values) > 0 else None
+        elif key != "mean":
+            result[key] = sum(t.get(key) or 0 for t in timings)
+    means = [(t["mean"], t["requests"]) for t in timings if t.get("mean") is not None]
+    requests = sum(r for _, r in means)
+    result["mean"] = sum(m * r for m, r in means) / requests if requests > 0 else None
+    return result
+
+
+def merge(reports):
+    """Combines the JSON outputs of several shards. Route collections which ran on every shard, like the builtin
+    ROUTES, are joined into one record."""
+    records = []
+    collections = {}
+    for report in reports:
+        for record in report:
+            if "results" not in record:
+                records.append(record)
+                continue
+            if record["title"] not in collections:
+                collections[record["title"]] = dict(record, results=list(record["results"]))
+                records.append(collections[record["title"]])
+                continue
+            merged = collections[record["title"]]
+            merged["success"] = merged["success"] and record["success"]
+            merged["results"] += record["results"]
+            timing = merge_timing([merged.get("timing"), record.get("timing")])
+            if timing is not None:
+                merged["timing"] = timing
+    return records
+
+
+def load_reports(files):
+    reports = []
+    for file in files:
+        with open(file) as f:
+            reports.append(json.load(f))
+    return reports
@@ -0,0 +1,567 @@
+import asyncio
+import datetime
+import hashlib
+import http.client
+import io
+import socket
+import ssl
+import threading
+import time
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urljoin, urlsplit
+
+import requests as r
+from requests.adapters import HTTPAdapter
+from requests.cookies import MockRequest, MockResponse, RequestsCookieJar
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.connection import allowed_gai_family
+
+ENGINES = ("requests", "asyncio")
+# requests which may be sent again when a reused connection turns out to be closed
+RETRY_METHODS = ("GET", "HEAD", "OPTIONS", "TRACE")
+# seconds the asyncio engine waits for a connection or the next data of a response
+DEFAULT_TIMEOUT = 60
+
+
+class Timing:
+    """Durations in seconds of the phases of a single request. Reused connections have no dns, connect and tls time."""
+    PHASES = ("dns", "connect", "tls", "ttfb", "total")
+
+    def __init__(self):
+        self.dns = 0.0
+        self.connect = 0.0
+        self.tls = 0.0
+        self.ttfb = None
+        self.total = None
+        self.request_bytes = 0
+        self.response_bytes = 0
+
+    @classmethod
+    def from_response(cls, response, total):
+        timing = cls()
+        timing.ttfb = response.elapsed.total_seconds()
+        timing.total = total
+        timing.measure(response)
+        return timing
+
+    def measure(self, response):
+        body = response.request.body if response.request is not None else None
+        self.request_bytes = len(body) if body is not None else 0
+        self.response_bytes = len(response.content) if response.content is not None else 0
+
+    def to_dict(self):
+        return {
+            "dns": self.dns,
+            "connect": self.connect,
+            "tls": self.tls,
+            "ttfb": self.ttfb,
+            "total": self.total,
+            "request-bytes": self.request_bytes,
+            "response-bytes": self.response_bytes,
+        }
+
+    def __str__(self):
+        phases = ", ".join(f"{phase} {getattr(self, phase) * 1000:.1f}ms" for phase in self.PHASES
+                           if getattr(self, phase) is not None)
+        return phases + f", sent {self.request_bytes} B, received {self.response_bytes} B"
+
+
+CHUNK_SIZE = 65536
+
+
+class BodyReader:
+    """Consumes a response body chunk by chunk. It stops at the size limit, hashes the body if asked to
+    and only keeps the body when it is needed afterwards."""
+    def __init__(self, max_bytes=None, sha256=False, keep=True):
+        self.max_bytes = max_bytes
+        self.digest = hashlib.sha256() if sha256 else None
+        self.keep = keep
+        self.chunks = []
+        self.size = 0
+        self.truncated = False
+
+    def feed(self, chunk):
+        """Returns False as soon as the body exceeds the size limit"""
+        if self.max_bytes is not None and self.size + len(chunk) > self.max_bytes:
+            chunk = chunk[:self.max_bytes - self.size]
+            self.truncated = True
+        self.size += len(chunk)
+        if self.digest is not None:
+            self.digest.update(chunk)
+        if self.keep:
+            self.chunks.append(chunk)
+        return not self.truncated
+
+    def sha256(self):
+        return self.digest.hexdigest() if self.digest is not None else None
+
+    def content(self):
+        return b"".join(self.chunks) if self.keep else None
+
+    def read(self, response):
+        """Reads the body of a streamed requests response"""
+        listeners = getattr(response, 'body_listeners', [])
+        for chunk in response.iter_content(CHUNK_SIZE):
+            for listener in listeners:
+                listener.feed(chunk)
+            if not self.feed(chunk):
+                response.close()
+                break
+        response._content = self.content()
+        response._content_consumed = True
+        for listener in listeners:
+            listener.done(self.truncated)
+        return self
+
+
+class BodyCopy:
+    """Collects the chunks of a streamed body as BodyReader reads them. A truncated body keeps the whole chunk
+    which went over the limit, so it still exceeds the limit when it is used again."""
+    def __init__(self, callback):
+        self.callback = callback
+        self.chunks = []
+
+    def feed(self, chunk):
+        self.chunks.append(chunk)
+
+    def done(self, truncated):
+        self.callback(b"".join(self.chunks), truncated)
+
+
+def on_body(response, callback, stream=False):
+    """Calls callback(content, truncated) with the body of the response. Streamed bodies are passed on once
+    BodyReader has read them, without reading them a second time."""
+    if stream:
+        response.body_listeners = getattr(response, 'body_listeners', []) + [BodyCopy(callback)]
+    else:
+        callback(response.content if response.content is not None else b"", False)
+
+
+_current = threading.local()
+
+
+class TimedConnectionMixin:
+    def _new_conn(self):
+        timing = getattr(_current, 'timing', None)
+        if timing is None:
+            return super()._new_conn()
+        start = time.perf_counter()
+        try:
+            addresses = socket.getaddrinfo(self._dns_host, self.port, allowed_gai_family(), socket.SOCK_STREAM)
+        except OSError:
+            # let urllib3 report the error
+            return super()._new_conn()
+        resolved = time.perf_counter()
+        timing.dns += resolved - start
+        host = self._dns_host
+        self._dns_host = addresses[0][4][0]
+        try:
+            sock = super()._new_conn()
+        except Exception:
+            self._dns_host = host
+            sock = super()._new_conn()
+        finally:
+            self._dns_host = host
+        timing.connect += time.perf_counter() - resolved
+        return sock
+
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+    def connect(self):
+        timing = getattr(_current, 'timing', None)
+        start = time.perf_counter()
+        super().connect()
+        if timing is not None:
+            timing.tls += max(time.perf_counter() - start - timing.dns - timing.connect, 0.0)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimingAdapter(HTTPAdapter):
+    """Records a Timing for every request and attaches it to the response as `timing`"""
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool, "https": TimedHTTPSConnectionPool}
+
+    def send(self, request, stream=False, **kwargs):
+        timing = Timing()
+        _current.timing = timing
+        start = time.perf_counter()
+        try:
+            response = super().send(request, stream=stream, **kwargs)
+        finally:
+            _current.timing = None
+        timing.ttfb = time.perf_counter() - start
+        if not stream:
+            timing.measure(response)
+            timing.total = time.perf_counter() - start
+        response.timing = timing
+        return response
+
+
+class AsyncSession:
+    """HTTP/1.1 client on top of asyncio streams. Responses are plain `requests` responses."""
+    asynchronous = True
+
+    def __init__(self, cookies=True, keep_alive=True, pool_maxsize=10, timeout=DEFAULT_TIMEOUT):
+        self.cookies = RequestsCookieJar() if cookies else None
+        self.keep_alive = keep_alive
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.max_redirects = r.models.DEFAULT_REDIRECT_LIMIT
+        self.ssl_context = None
+        # idle connections only live as long as the event loop of run()
+        self.idle = {}
+
+    def run(self, coroutine):
+        return asyncio.run(self._run(coroutine))
+
+    async def _run(self, coroutine):
+        try:
+            return await coroutine
+        finally:
+            idle, self.idle = self.idle, {}
+            for connections in idle.values():
+                for reader, writer in connections:
+                    await close_connection(writer)
+
+    async def request(self, method, url, headers=None, data=None, stream=False, body_reader=None,
+                      allow_redirects=True):
+        """Follows redirects like a requests session, the responses before the last one are in its history"""
+        history = []
+        while True:
+            response = await self.send(method, url, headers, data, body_reader, allow_redirects)
+            if not allow_redirects or not response.is_redirect:
+                response.history = history
+                return response
+            if len(history) >= self.max_redirects:
+                raise r.TooManyRedirects(f"Exceeded {self.max_redirects} redirects.", response=response)
+            history.append(response)
+            url = urljoin(response.url, response.headers["Location"])
+            method, headers, data = redirect_request(response, method, url, headers, data)
+
+    async def send(self, method, url, headers=None, data=None, body_reader=None, allow_redirects=False):
+        prepared = r.Request(method, url, headers=headers, data=data).prepare()
+        if self.cookies is not None:
+            prepared.prepare_cookies(self.cookies)
+        parts = urlsplit(prepared.url)
+        secure = parts.scheme == "https"
+        if secure and self.ssl_context is None:
+            self.ssl_context = ssl.create_default_context()
+        key = (parts.hostname, parts.port or (443 if secure else 80), secure)
+
+        while True:
+            timing = Timing()
+            start = time.perf_counter()
+            connections = self.idle.get(key, [])
+            reused = len(connections) > 0
+            if reused:
+                reader, writer = connections.pop()
+                if reader.at_eof() or writer.is_closing():
+                    # closed by the server while it was idle, nothing was sent yet
+                    await close_connection(writer)
+                    continue
+            else:
+                try:
+                    reader, writer = await asyncio.wait_for(self.connect(*key, timing), self.timeout)
+                except asyncio.TimeoutError:
+                    raise r.ConnectTimeout(f"Connecting to {parts.netloc} timed out after {self.timeout}s")
+            try:
+                writer.write(request_head(prepared, parts, self.keep_alive) + request_body(prepared))
+                await asyncio.wait_for(writer.drain(), self.timeout)
+                version, status_code, reason, headers = await asyncio.wait_for(read_head(reader), self.timeout)
+            except asyncio.TimeoutError:
+                await close_connection(writer)
+                raise r.ReadTimeout(f"No response from {parts.netloc} within {self.timeout}s")
+            except (ConnectionError, asyncio.IncompleteReadError):
+                await close_connection(writer)
+                if reused and prepared.method in RETRY_METHODS:
+                    # the server closed the idle connection, the request can't have had an effect
+                    continue
+                raise
+            break
+
+        keep = False
+        try:
+            elapsed = time.perf_counter() - start
+            if body_reader is None or allow_redirects and status_code in r.models.REDIRECT_STATI \
+                    and "Location" in headers:
+                # the body of a redirect is not the one the caller reads
+                body_reader = BodyReader()
+            complete = True
+            chunks = iter_body(reader, method, status_code, headers)
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), self.timeout)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    raise r.ReadTimeout(f"No data from {parts.netloc} within {self.timeout}s")
+                if not body_reader.feed(chunk):
+                    complete = False
+                    break
+            content = body_reader.content()
+            timing.ttfb = elapsed
+            timing.total = time.perf_counter() - start
+            keep = complete and self.keep_alive and reusable(version, method, status_code, headers) \
+                and len(self.idle.get(key, [])) < self.pool_maxsize
+        finally:
+            if keep:
+                self.idle.setdefault(key, []).append((reader, writer))
+            else:
+                await close_connection(writer)
+
+        response = r.Response()
+        response.status_code = status_code
+        response.reason = reason
+        response.headers = CaseInsensitiveDict(headers.items())
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = content
+        response.url = prepared.url
+        response.request = prepared
+        response.elapsed = datetime.timedelta(seconds=elapsed)
+        if self.cookies is not None:
+            self.cookies.extract_cookies(MockResponse(headers), MockRequest(prepared))
+        timing.measure(response)
+        timing.response_bytes = body_reader.size
+        response.timing = timing
+        return response
+
+    async def connect(self, host, port, secure, timing):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        addresses = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        resolved = time.perf_counter()
+        timing.dns = resolved - start
+        error = None
+        for address in addresses:
+            try:
+                reader, writer = await asyncio.open_connection(address[4][0], port)
+                break
+            except OSError as e:
+                error = e
+        else:
+            raise error
+        connected = time.perf_counter()
+        timing.connect = connected - resolved
+        if secure:
+            await writer.start_tls(self.ssl_context, server_hostname=host)
+            timing.tls = time.perf_counter() - connected
+        return reader, writer
+
+    def get(self, url, **kwargs):
+        return self.run(self.request("GET", url, **kwargs))
+
+    def post(self, url, **kwargs):
+        return self.run(self.request("POST", url, **kwargs))
+
+    def put(self, url, **kwargs):
+        return self.run(self.request("PUT", url, **kwargs))
+
+    def delete(self, url, **kwargs):
+        return self.run(self.request("DELETE", url, **kwargs))
+
+
+def redirect_request(response, method, url, headers, data):
+    """Method, headers and body of the request following a redirect, the way requests rewrites them"""
+    status_code = response.status_code
+    if status_code in (302, 303) and method != "HEAD" or status_code == 301 and method == "POST":
+        method = "GET"
+    headers = CaseInsensitiveDict(headers or {})
+    headers.pop("Cookie", None)
+    if status_code not in (307, 308):
+        for name in ("Content-Type", "Content-Length", "Transfer-Encoding"):
+            headers.pop(name, None)
+        data = None
+    if urlsplit(response.url).hostname != urlsplit(url).hostname:
+        headers.pop("Authorization", None)
+    return method, headers, data
+
+
+async def close_connection(writer):
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except (ConnectionError, ssl.SSLError):
+        pass
+
+
+def reusable(version, method, status_code, headers):
+    connection = headers.get("Connection", "").lower()
+    if connection == "close" or (version == "HTTP/1.0" and connection != "keep-alive"):
+        return False
+    # without a length the body ends when the connection is closed
+    return method == "HEAD" or status_code in (204, 304) or 100 <= status_code < 200 \
+        or headers.get("Transfer-Encoding", "").lower() == "chunked" or headers.get("Content-Length") is not None
+
+
+def request_head(prepared, parts, keep_alive=False):
+    target = parts.path or "/"
+    if parts.query:
+        target += "?" + parts.query
+    lines = [f"{prepared.method} {target} HTTP/1.1", "Host: " + parts.netloc]
+    headers = CaseInsensitiveDict(prepared.headers)
+    headers.setdefault("User-Agent", r.utils.default_user_agent())
+    headers.setdefault("Accept", "*/*")
+    headers["Connection"] = "keep-alive" if keep_alive else "close"
+    for k, v in headers.items():
+        lines.append(k + ": " + v)
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def request_body(prepared):
+    if prepared.body is None:
+        return b""
+    if isinstance(prepared.body, str):
+        return prepared.body.encode("utf-8")
+    return prepared.body
+
+
+async def read_head(reader):
+    status_line = (await reader.readline()).decode("latin-1").rstrip("\r\n")
+    parts = status_line.split(" ", 2)
+    if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+        raise ConnectionError("Invalid status line: " + status_line)
+    lines = []
+    while True:
+        line = await reader.readline()
+        lines.append(line)
+        if line in (b"\r\n", b"\n", b""):
+            break
+    headers = http.client.parse_headers(io.BytesIO(b"".join(lines)))
+    return parts[0], int(parts[1]), parts[2] if len(parts) > 2 else "", headers
+
+
+async def iter_body(reader, method, status_code, headers):
+    if method == "HEAD" or status_code in (204, 304) or 100 <= status_code < 200:
+        return
+    if headers.get("Transfer-Encoding", "").lower() == "chunked":
+        while True:
+            size = int((await reader.readline()).split(b";")[0].strip(), 16)
+            if size == 0:
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return
+            while size > 0:
+                chunk = await reader.readexactly(min(size, CHUNK_SIZE))
+                size -= len(chunk)
+                yield chunk
+            await reader.readline()
+    elif headers.get("Content-Length") is not None:
+        remaining = int(headers["Content-Length"])
+        while remaining > 0:
+            chunk = await reader.readexactly(min(remaining, CHUNK_SIZE))
+            remaining -= len(chunk)
+            yield chunk
+    else:
+        while True:
+            chunk = await reader.read(CHUNK_SIZE)
+            if chunk == b"":
+                return
+            yield chunk
+
+
+class ConnectionPool:
+    """Connection pools shared by every session. The sessions only keep their own cookies."""
+    def __init__(self, pool_connections=10, pool_maxsize=10, keep_alive=True):
+        self.settings = (pool_connections, pool_maxsize, keep_alive)
+        self.keep_alive = keep_alive
+        self.adapter = TimingAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+
+    def mount(self, session):
+        session.mount("http://", self.adapter)
+        session.mount("https://", self.adapter)
+        if not self.keep_alive:
+            session.headers["Connection"] = "close"
+        return session
+
+    def close(self):
+        self.adapter.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def pool_settings(options):
+    return (int(options.get('pool_connections', 10)), int(options.get('pool_maxsize', 10)),
+            bool(options.get('keep_alive', True)))
+
+
+def connection_pool(options):
+    global _pool
+    settings = pool_settings(options)
+    with _pool_lock:
+        if _pool is None or _pool.settings != settings:
+            if _pool is not None:
+                # closes the idle keep-alive connections, connections in use are closed when they are released
+                _pool.close()
+            _pool = ConnectionPool(*settings)
+        return _pool
+
+
+def close_connection_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+def buffered_response(status_code, reason, headers, content, method, url, request_headers=None, data=None):
+    """A response whose body is already in memory, for responses that don't come from the network"""
+    response = r.Response()
+    response.status_code = status_code
+    response.reason = reason
+    response.headers = CaseInsensitiveDict(headers)
+    response.encoding = get_encoding_from_headers(response.headers)
+    response._content = content
+    response._content_consumed = True
+    response.url = url
+    response.elapsed = datetime.timedelta(0)
+    response.request = r.Request(method.upper(), url, headers=request_headers, data=data).prepare()
+    return response
+
+
+def create_session(options, use_session=None):
+    session = _create_session(options, use_session)
+    path = options.get('replay') or options.get('record')
+    if path is not None:
+        from .cassette import CassetteSession, cassette
+        session = CassetteSession(session, cassette(path), replay=options.get('replay') is not None)
+    if options.get('cache'):
+        from .httpcache import CachingSession, http_cache
+        session = CachingSession(session, http_cache(options['cache']), options['cache'])
+    return session
+
+
+def _create_session(options, use_session=None):
+    if use_session is None:
+        use_session = options.get('session', False)
+    engine = options.get('engine', 'requests')
+    # cassettes and the http cache wrap the requests engine
+    if options.get('replay') or options.get('record') or options.get('cache'):
+        engine = 'requests'
+    if engine == 'asyncio':
+        _, pool_maxsize, keep_alive = pool_settings(options)
+        return AsyncSession(cookies=use_session, keep_alive=keep_alive, pool_maxsize=pool_maxsize,
+                            timeout=float(options.get('timeout', DEFAULT_TIMEOUT)))
+    elif engine == 'requests':
+        session = r.session()
+        if not use_session:
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        return connection_pool(options).mount(session)
+    raise ValueError(f"Unknown engine: '{engine}'")
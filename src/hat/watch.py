@@ -0,0 +1,99 @@
+import fnmatch
+import os
+import time
+import traceback
+
+from .main import tasks, find_hatfiles, reload_suite, setup, run_tests, task_context, task_ignores_builtin, \
+    name_to_python
+from .httpcache import reset_caches
+
+
+def snapshot(paths):
+    files = {}
+    for file in find_hatfiles(paths):
+        try:
+            stat = os.stat(file)
+        except OSError:
+            continue
+        files[file] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+def fingerprints():
+    result = {}
+    for name, task in tasks.items():
+        with task_context(task):
+            result[name] = task.fingerprint()
+    return result
+
+
+class Watcher:
+    """Reloads the hatfiles when they change and tells which tests have to run again. The process, its imports
+    and the shared connection pool stay warm between the runs."""
+    def __init__(self, paths, command_args=None, pattern=None):
+        self.paths = paths
+        self.command_args = command_args if command_args is not None else {}
+        self.pattern = name_to_python(pattern) if pattern is not None else None
+        self.tests = None
+        self.files = {}
+        self.fingerprints = {}
+
+    def load(self):
+        """Loads the hatfiles and returns the names of the new and changed tests"""
+        self.files = snapshot(self.paths)
+        self.tests = reload_suite(self.paths)
+        setup(self.tests, self.command_args)
+        current = fingerprints()
+        changed = [name for name, fingerprint in current.items()
+                   if fingerprint is None or self.fingerprints.get(name) != fingerprint]
+        self.fingerprints = current
+        return changed
+
+    def poll(self):
+        """The tests to run after a change of the hatfiles, None if nothing changed"""
+        if snapshot(self.paths) == self.files:
+            return None
+        return self.select(self.load())
+
+    def select(self, changed):
+        names = set(changed)
+        if self.pattern is not None:
+            names |= {name for name in tasks if fnmatch.fnmatchcase(name, self.pattern)}
+        # tests depending on a changed test run again as well
+        added = True
+        while added:
+            added = False
+            for name, task in tasks.items():
+                if name not in names and any(d in names for d in task.depends):
+                    names.add(name)
+                    added = True
+        return [name for name, task in tasks.items()
+                if name in names and not (task.builtin and task_ignores_builtin(self.tests, task))]
+
+
+def watch(paths, args, command_args, create_output, pattern=None, interval=1.0):
+    """Runs the tests, then reruns the changed ones whenever a hatfile changes until interrupted"""
+    watcher = Watcher(paths, command_args, pattern)
+    first = True
+    try:
+        while True:
+            try:
+                names = watcher.select(watcher.load()) if first else watcher.poll()
+            except Exception:
+                # most likely a hatfile in the middle of an edit, try again after the next change
+                traceback.print_exc()
+                names = None
+            first = False
+            if names is not None:
+                if len(names) > 0:
+                    reset_caches()
+                    output = create_output()
+                    for result in run_tests(watcher.tests, names, args, command_args):
+                        output.write(result)
+                    output.finalize()
+                else:
+                    print("No changed tests")
+                print("Watching " + ", ".join(paths) + " for changes")
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        return 0
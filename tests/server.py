@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 from http.server import BaseHTTPRequestHandler
-from http.server import HTTPServer
+from http.server import HTTPServer, ThreadingHTTPServer
 import json
+import threading
 
 test_json = {
     "id": 1,
@@ -32,6 +33,57 @@ class TestRequestHandler(BaseHTTPRequestHandler):
         self.wfile.flush()
 
 
+class LocalHandler(BaseHTTPRequestHandler):
+    """Base for the handlers of LocalServer: keep-alive connections and no request log"""
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, with Nagle every response would wait for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def reply_json(self, status, data, headers=None):
+        self.reply(status, json.dumps(data).encode(), dict({"Content-Type": "application/json"}, **(headers or {})))
+
+    def request_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length > 0 else b""
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalServer:
+    """A multi-threaded server on a free port of 127.0.0.1, served from a thread of the test process"""
+    def __init__(self, handler):
+        self.web_server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.web_server.daemon_threads = True
+
+    @property
+    def host(self):
+        return "http://127.0.0.1:{}/".format(self.web_server.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.web_server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.web_server.shutdown()
+        self.web_server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
 class WebServer():
     def __init__(self, host_name, server_port):
         self.web_server = HTTPServer((host_name, server_port), TestRequestHandler)
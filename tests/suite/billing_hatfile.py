@@ -0,0 +1,14 @@
+from hat.http import Route, current_config
+from hat.builtin import test_routes
+from hat.decorators import test
+
+HOSTS = ["http://billing.example.com/"]
+
+ROUTES = [
+    Route("/invoices", "GET", response=200, doc="List invoices"),
+]
+
+
+@test()
+def test_config():
+    return current_config()['hosts'] == HOSTS
@@ -0,0 +1,20 @@
+from hat.http import Route, current_config
+from hat.builtin import test_routes
+from hat.decorators import test
+
+HOSTS = ["http://users.example.com/"]
+
+ROUTES = [
+    Route("/users", "GET", response=200, doc="List users"),
+]
+
+
+@test()
+def test_login():
+    return True
+
+
+@test(depends=[test_login])
+def test_config():
+    """Sees the hosts of this hatfile only"""
+    return current_config()['hosts'] == HOSTS
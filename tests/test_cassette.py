@@ -0,0 +1,139 @@
+import gzip
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+from hat import http, main
+from hat.cassette import Cassette, CassetteSession, interaction_key
+from hat.http import Route, Response, Extractor
+from hat.transport import create_session, CHUNK_SIZE
+from .server import LocalHandler, LocalServer
+
+BIG = b"x" * (4 * CHUNK_SIZE)
+
+
+class Handler(LocalHandler):
+    counter = 0
+
+    def do_GET(self):
+        if self.path == "/big":
+            self.reply(200, BIG)
+            return
+        Handler.counter += 1
+        self.reply_json(200, {"id": 7, "count": Handler.counter})
+
+    def do_POST(self):
+        self.reply_json(201, json.loads(self.request_body()))
+
+
+class CassetteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.server = LocalServer(Handler).start()
+        self.host = self.server.host
+        Handler.counter = 0
+
+    def tearDown(self):
+        self.server.stop()
+        self.directory.cleanup()
+
+    def routes(self):
+        return [
+            Route("/item", "GET", response=Response(200, body={"id": 7, "count": 1}),
+                  store=[Extractor("response.body-object.id", "id")]),
+            Route("/item", "GET", response=Response(200, body={"id": 7, "count": 2})),
+            Route("/items", "POST", body={"id": "{id}"}, response=Response(201, body={"id": "7"})),
+        ]
+
+    def run_routes(self, options):
+        session = create_session(options)
+        return http.handle_routes(session, [self.host], self.routes(), workers=1)
+
+    def test_record_replay(self):
+        path = os.path.join(self.directory.name, "cassette.json.gz")
+        cassette = Cassette(path)
+        session = CassetteSession(create_session({}), cassette)
+        results = http.handle_routes(session, [self.host], self.routes(), workers=1)
+        self.assertTrue(all(r.success for r in results), [r.message for r in results])
+        cassette.save()
+        with gzip.open(path, "rt") as f:
+            self.assertEqual(len(json.load(f)["interactions"]), 2)
+
+        self.server.stop()
+        replay = CassetteSession(create_session({}), Cassette(path).load(), replay=True)
+        results = http.handle_routes(replay, [self.host], self.routes(), workers=1)
+        self.assertTrue(all(r.success for r in results), [r.message for r in results])
+        self.assertEqual(results[0].to_dict()["response"]["body-object"], {"id": 7, "count": 1})
+
+    def test_record_stops_at_budget(self):
+        path = os.path.join(self.directory.name, "cassette.json")
+        cassette = Cassette(path)
+        routes = [Route("/big", "GET", max_bytes=CHUNK_SIZE // 2)]
+        results = http.handle_routes(CassetteSession(create_session({}), cassette), [self.host], routes, workers=1)
+        self.assertIn("exceeds budget", results[0].message)
+        body = cassette.interactions[interaction_key("GET", self.host + "big", None)][0]["body"]["text"]
+        self.assertLessEqual(len(body), CHUNK_SIZE)
+
+        replay = CassetteSession(create_session({}), cassette, replay=True)
+        results = http.handle_routes(replay, [self.host], routes, workers=1)
+        self.assertIn("exceeds budget", results[0].message)
+
+    def test_record_in_process_pool(self):
+        path = os.path.join(self.directory.name, "cassette.json")
+        tasks = dict(main.tasks)
+        main.tasks.clear()
+        try:
+            for name in ("test_a", "test_b"):
+                t = main.TestWrapper()
+                t.name = name
+                t.func = lambda name=name: create_session({"record": path}).get(self.host + name).status_code == 200
+                main.tasks[name] = t
+            # forked workers inherit the tasks, the module is only used to load them otherwise
+            results = list(main.run_tests(sys.modules[__name__], ["test_a", "test_b"], {},
+                                          {'p': '2', 'pool': 'process'}))
+        finally:
+            main.tasks.clear()
+            main.tasks.update(tasks)
+        self.assertTrue(all(main.is_success(r) for r in results))
+        with open(path) as f:
+            keys = sorted(json.load(f)["interactions"])
+        self.assertEqual(keys, [interaction_key("GET", self.host + name, None) for name in ("test_a", "test_b")])
+
+    def test_replay_missing(self):
+        path = os.path.join(self.directory.name, "cassette.json")
+        replay = CassetteSession(create_session({}), Cassette(path).load(), replay=True)
+        results = http.handle_routes(replay, [self.host], self.routes()[:1], workers=1)
+        self.assertFalse(results[0].success)
+
+    def test_save_keeps_other_interactions(self):
+        path = os.path.join(self.directory.name, "cassette.json")
+        first = Cassette(path)
+        first.record("GET", "http://a/", None, _response(b"a"), b"a")
+        first.save()
+        second = Cassette(path).load()
+        second.record("GET", "http://b/", None, _response(b"b"), b"b")
+        second.save()
+        interactions = Cassette(path).load().interactions
+        self.assertEqual(set(interactions), {interaction_key("GET", "http://a/", None),
+                                             interaction_key("GET", "http://b/", None)})
+
+    def test_create_session_wraps_engine(self):
+        path = os.path.join(self.directory.name, "cassette.json")
+        session = create_session({"engine": "asyncio", "record": path})
+        self.assertIsInstance(session, CassetteSession)
+        self.assertFalse(session.replay)
+
+
+def _response(content):
+    import requests as r
+    resp = r.Response()
+    resp.status_code = 200
+    resp.reason = "OK"
+    resp._content = content
+    return resp
+
+
+if __name__ == '__main__':
+    unittest.main()
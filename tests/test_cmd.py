@@ -0,0 +1,33 @@
+import io
+import json
+import unittest
+
+from hat import cmd
+
+
+class OutputTestCase(unittest.TestCase):
+    def test_json_lines_output(self):
+        stream = io.StringIO()
+        output = cmd.JsonLinesOutput(stream)
+        output.write([["test_passes: "], True])
+        self.assertEqual(json.loads(stream.getvalue()), {"success": True, "message": "test_passes: "})
+        output.write([["test_fails: ", "output"], False])
+        output.finalize()
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(records[1], {"success": False, "message": "test_fails: \noutput"})
+
+    def test_create_output(self):
+        self.assertIsInstance(cmd.create_output({}), cmd.ReadableOutput)
+        self.assertIsInstance(cmd.create_output({'j': True}), cmd.JsonOutput)
+        self.assertIsInstance(cmd.create_output({'j': 'lines'}), cmd.JsonLinesOutput)
+
+
+class ParseArgsTestCase(unittest.TestCase):
+    def test_merge_reports(self):
+        self.assertEqual(cmd.parse_args(["-j", "merge", "a.json", "b.json"]),
+                         ("merge", ["-j"], None, ["a.json", "b.json"]))
+        self.assertEqual(cmd.parse_args(["merge", "a.json", "-j", "--x=1"]), ("merge", [], None, ["a.json"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
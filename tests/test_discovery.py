@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from hat import discovery, main
+
+
+class DiscoveryCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.env = mock.patch.dict(os.environ, {"XDG_CACHE_HOME": os.path.join(self.dir.name, "cache")})
+        self.env.start()
+        self.file = os.path.join(self.dir.name, "hatfile.py")
+        with open(self.file, "w") as f:
+            f.write("TESTS = 1\n")
+
+    def tearDown(self):
+        self.env.stop()
+        self.dir.cleanup()
+
+    def test_store_and_load(self):
+        description = {"ignore_builtin": False, "tests": {"test_a": {"short_help": ["test-a"]}}}
+        self.assertIsNone(discovery.load(self.file))
+        discovery.store(self.file, description, discovery.file_key(self.file))
+        self.assertTrue(discovery.cache_path(self.file).startswith(os.path.join(self.dir.name, "cache", "hat")))
+        self.assertEqual(discovery.load(self.file), description)
+
+        with open(self.file, "a") as f:
+            f.write("CHANGED = True\n")
+        self.assertIsNone(discovery.load(self.file))
+
+    def test_list_from_description(self):
+        tasks = dict(main.tasks)
+        main.tasks.clear()
+        try:
+            t = main.TestWrapper()
+            t.name = "test_a"
+            t.args = ["user_name"]
+            t.func = lambda user_name=None: True
+            t.func.__doc__ = "Checks a"
+            main.tasks[t.name] = t
+            description = main.describe(None)
+        finally:
+            main.tasks.clear()
+            main.tasks.update(tasks)
+
+        self.assertEqual(main.list_tests(None, None, {}, description), ["test_a [--user-name]"])
+        self.assertEqual(main.list_tests(None, "test-a", {'v': True}, description),
+                         ["test_a [--user-name]", "  Checks a"])
+        self.assertEqual(main.list_tests(None, "missing", {}, description), ["Test not found: 'missing'"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from hat import history, main
+
+
+class HistoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.env = mock.patch.dict(os.environ, {"XDG_CACHE_HOME": self.dir.name})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        self.dir.cleanup()
+
+    def test_failed_first(self):
+        h = history.History.load(["hatfile.py"])
+        h.record([("a", True, 0.1), ("b", False, 0.3), ("c", False, 0.2)])
+        h.save()
+        h = history.History.load(["hatfile.py"])
+        names = ["a", "b", "c", "d"]
+        self.assertEqual(h.failed_first(names), ["b", "c", "a", "d"])
+        self.assertEqual(h.only_failed(names), ["b", "c"])
+        self.assertEqual(h.duration("b"), 0.3)
+
+        h.record([("b", True, 0.1), ("c", True, 0.1)])
+        self.assertEqual(h.only_failed(names), names)
+        self.assertEqual(history.History.load(["other.py"]).tests, {})
+
+    def test_slowest(self):
+        records = [("a", True, 0.1), ("b", False, 0.3), ("c", False, None), ("d", True, 0.2)]
+        self.assertEqual(history.slowest(records, 2), [("b", 0.3), ("d", 0.2)])
+
+    def test_scheduler_records(self):
+        tasks = dict(main.tasks)
+        main.tasks.clear()
+        try:
+            for name, func, depends in (("a", lambda: False, []), ("b", lambda: True, ["a"]), ("c", lambda: True, [])):
+                t = main.TestWrapper()
+                t.name = name
+                t.func = func
+                t.depends = depends
+                main.tasks[name] = t
+            records = []
+            list(main.runall(None, {}, {}, records))
+        finally:
+            main.tasks.clear()
+            main.tasks.update(tasks)
+        self.assertEqual([(name, success) for name, success, _ in records], [("a", False), ("b", False), ("c", True)])
+        self.assertIsNone(records[1][2])
+        self.assertGreaterEqual(records[2][2], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
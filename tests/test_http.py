@@ -1,11 +1,19 @@
+import http.client as http_client
+import hashlib
+import io
+import json
+import pickle
+import time
 import unittest
 import requests as r
+from requests.cookies import MockRequest, MockResponse
 
 from hat.http import Extractor
-from .server import WebServer, host_name, server_port
+from . import server
+from .server import WebServer, LocalHandler, LocalServer, host_name, server_port
 from multiprocessing import Process
 
-from hat import http
+from hat import http, transport
 
 
 class UnitTests(unittest.TestCase):
@@ -15,6 +23,195 @@ class UnitTests(unittest.TestCase):
         filtered = filter_routes("1,2,6", routes)
         self.assertEqual(filtered, ["abcd", "def", "xzy"])
 
+    def test_extractor(self):
+        result = {"response": {"body-object": {"items": [{"id": 7}, {"id": 8}], "0": "zero"}}}
+        self.assertEqual(Extractor("response.body-object.items.1.id", "id").value_from_result(result), 8)
+        self.assertEqual(Extractor("response.body-object.0", "id").value_from_result(result), "zero")
+        self.assertEqual(Extractor("response.body-object.items.-1.id", "id").value_from_result(result), 8)
+        with self.assertRaises(KeyError):
+            Extractor("response.body-object.missing", "id").value_from_result(result)
+
+    def test_compare_json(self):
+        expected = {"id": 1, "items": [{"id": 1, "tags": ["a"]}, {"id": 2, "tags": []}], "active": True}
+        actual = {"id": 1, "items": [{"id": 1, "tags": ["a"]}, {"id": 3, "tags": [], "new": 1}], "active": 1}
+        self.assertEqual(http.compare_json(expected, expected), [])
+        self.assertEqual(http.compare_json(expected, actual), [
+            "body.items.1.id: expected 2, got 3",
+            "body.items.1.new: unexpected 1",
+            "body.active: expected true, got 1",
+        ])
+        self.assertEqual(http.compare_json(expected, actual, max_diffs=1), ["body.items.1.id: expected 2, got 3"])
+        self.assertEqual(http.compare_json(expected, actual, partial=True, ignore=["items.*.id", "active"]), [])
+        self.assertEqual(http.compare_json([1, 2], [1, 2, 3], partial=True), [])
+        self.assertEqual(http.compare_json([1, 2], [1]), ["body: expected 2 items, got 1"])
+
+    def test_response_body_diff(self):
+        response = http.Response(200, body={"id": "{id}", "name": "test"}, ignore=["updated"])
+        self.assertTrue(response.compare_body('{"id": "1", "name": "test", "updated": 2}', {"id": 1}))
+        self.assertEqual(response.body_diff('{"id": "2", "name": "test"}', {"id": 1}),
+                         ['body.id: expected "1", got "2"'])
+        self.assertEqual(response.body_diff('<html>', {"id": 1}), ["body: not valid JSON"])
+
+    def test_compiled_templates(self):
+        static = {"name": "test", "tags": ["a", "{{b}}"]}
+        template = http.compile_template({"id": http.ToInt("1{id}"), "static": static, "path": "/users/{user}"})
+        self.assertEqual(template.fields, {"id", "user"})
+        rendered = template.render({"id": 2, "user": "me"})
+        self.assertEqual(rendered, {"id": 12, "static": {"name": "test", "tags": ["a", "{b}"]}, "path": "/users/me"})
+        self.assertIs(template.render({"id": 3, "user": "you"})["static"], rendered["static"])
+        self.assertEqual(http._do_replace({"id": http.ToInt("1{id}"), "static": static, "path": "/users/{user}"},
+                                          {"id": 2, "user": "me"}), rendered)
+        with self.assertRaises(KeyError):
+            template.render({"id": 2})
+
+    def test_route_variables(self):
+        route = http.Route("/users/{userId}", "POST", headers={"Authorization": "Bearer {token}"},
+                           body={"group": "{groupId}", "admin": http.ToBool("{admin}")},
+                           response=http.Response(201, body={"id": "{userId}"}),
+                           store=[Extractor("response.body-object.id", "newId")])
+        self.assertEqual(route.variables(), ["admin", "groupId", "token", "userId"])
+        self.assertEqual(route.stores(), ["newId"])
+
+    def test_construct_request_does_not_change_route(self):
+        route = http.Route("/", "POST", headers={"X-Id": "{id}"}, body={"id": http.ToInt("{id}"), "name": "test"})
+        first = http.construct_request(route.request, {"id": 1})
+        second = http.construct_request(route.request, {"id": 2})
+        self.assertEqual(json.loads(first["data"]), {"id": 1, "name": "test"})
+        self.assertEqual(json.loads(second["data"]), {"id": 2, "name": "test"})
+        self.assertEqual(first["headers"], {"X-Id": "1", "Content-Type": "application/json"})
+        self.assertEqual(dict(second), {"headers": {"X-Id": "2", "Content-Type": "application/json"},
+                                        "data": second.data})
+        self.assertIsInstance(route.request.body.data["id"], http.ToInt)
+        with self.assertRaises(TypeError):
+            first.headers["X-Id"] = "3"
+
+    def test_budgets_do_not_change_shared_response(self):
+        response = http.Response(200, body={"id": 1})
+        fast = http.Route("/", "GET", response=response, max_time=1)
+        small = http.Route("/items", "GET", response=response, max_bytes=10)
+        self.assertEqual((fast.response.max_time, fast.response.max_bytes), (1, None))
+        self.assertEqual((small.response.max_time, small.response.max_bytes), (None, 10))
+        self.assertEqual((response.max_time, response.max_bytes), (None, None))
+        self.assertIs(http.Route("/", "GET", response=response).response, response)
+
+    def test_shared_connection_pool(self):
+        from hat.transport import create_session
+        session = create_session({}, True)
+        stateless = create_session({"session": False})
+        self.assertIs(session.get_adapter("http://example.com"), stateless.get_adapter("http://example.com"))
+        self.assertIsNot(session.cookies, stateless.cookies)
+        headers = http_client.parse_headers(io.BytesIO(b"Set-Cookie: id=1\r\n\r\n"))
+        prepared = r.Request("GET", "http://example.com/").prepare()
+        for s in (session, stateless):
+            s.cookies.extract_cookies(MockResponse(headers), MockRequest(prepared))
+        self.assertEqual(len(session.cookies), 1)
+        self.assertEqual(len(stateless.cookies), 0)
+        other = create_session({"pool_maxsize": 20}, True)
+        self.assertIsNot(session.get_adapter("http://example.com"), other.get_adapter("http://example.com"))
+
+
+class DroppingHandler(LocalHandler):
+    """Answers the first request of a connection and drops the connection on the second one"""
+    received = []
+
+    def handle_one_request(self):
+        self.answered = getattr(self, 'answered', 0)
+        super().handle_one_request()
+
+    def handle_request(self):
+        self.request_body()
+        DroppingHandler.received.append(self.command)
+        if self.answered > 0:
+            self.close_connection = True
+            return
+        self.answered += 1
+        self.reply_json(200, {"id": 1})
+
+    do_GET = do_POST = handle_request
+
+
+class AsyncRetryTestCase(unittest.TestCase):
+    def setUp(self):
+        DroppingHandler.received = []
+        self.server = LocalServer(DroppingHandler).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_retry_only_safe_methods(self):
+        from hat.transport import AsyncSession
+
+        async def twice(session, method):
+            first = await session.request(method, self.server.host, data="{}")
+            return first, await session.request(method, self.server.host, data="{}")
+
+        session = AsyncSession()
+        self.assertEqual([resp.status_code for resp in session.run(twice(session, "GET"))], [200, 200])
+        self.assertEqual(DroppingHandler.received, ["GET", "GET", "GET"])
+
+        DroppingHandler.received = []
+        session = AsyncSession()
+        with self.assertRaises(Exception):
+            session.run(twice(session, "POST"))
+        self.assertEqual(DroppingHandler.received, ["POST", "POST"])
+
+
+class RedirectHandler(LocalHandler):
+    def handle_request(self):
+        body = self.request_body()
+        if self.path == "/old":
+            self.reply(301, headers={"Location": "/new"})
+        elif self.path == "/form":
+            self.reply(303, headers={"Location": "/new"})
+        elif self.path == "/loop":
+            self.reply(302, headers={"Location": "/loop"})
+        elif self.path == "/stall":
+            time.sleep(1)
+            self.reply_json(200, {})
+        else:
+            self.reply_json(200, {"method": self.command, "body": body.decode()})
+
+    do_GET = do_POST = handle_request
+
+
+class EnginesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalServer(RedirectHandler).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_redirects(self):
+        redirected = http.Response(200, body={"method": "GET", "body": ""})
+        routes = [
+            http.Route("/old", "GET", response=redirected),
+            http.Route("/form", "POST", body={"id": 1}, response=redirected),
+            http.Route("/loop", "GET"),
+        ]
+        for engine in transport.ENGINES:
+            session = transport.create_session({"engine": engine})
+            results = http.handle_routes(session, [self.server.host], routes, workers=1)
+            self.assertEqual([r.success for r in results], [True, True, False], engine)
+            self.assertIn("Exceeded 30 redirects", results[2].message, engine)
+            resp = transport.create_session({"engine": engine}).get(self.server.host + "old")
+            self.assertEqual([h.status_code for h in resp.history], [301], engine)
+            self.assertEqual(resp.url, self.server.host + "new", engine)
+
+    def test_replaced_pool_closed(self):
+        session = transport.create_session({"pool_maxsize": 3})
+        self.assertEqual(session.get(self.server.host + "new").status_code, 200)
+        adapter = session.get_adapter(self.server.host)
+        self.assertEqual(len(adapter.poolmanager.pools), 1)
+        transport.create_session({"pool_maxsize": 4})
+        self.assertEqual(len(adapter.poolmanager.pools), 0)
+        self.assertEqual(session.get(self.server.host + "new").status_code, 200)
+
+    def test_async_timeout(self):
+        session = transport.create_session({"engine": "asyncio", "timeout": 0.2})
+        result = http.handle_routes(session, [self.server.host], [http.Route("/stall", "GET")])[0]
+        self.assertFalse(result.success)
+        self.assertIn("within 0.2s", result.message)
+
 
 class HttpRoutesTestCase(unittest.TestCase):
     def setUp(self):
@@ -86,6 +283,137 @@ class HttpRoutesTestCase(unittest.TestCase):
                 self.assertEqual(result.response.json(), {"id": '1'})
         self.assertEqual(i, len(routes) - 1)
 
+    def test_handle_parallel_hosts(self):
+        session = r
+        hosts = self.hosts + ["http://127.0.0.1:{}".format(server_port)]
+        routes = [
+            http.Route("/", method="GET", response=200, store=[Extractor("response.body-object.id", "id")]),
+            http.Route("/", method="POST", body={"id": "{id}"}, response=201),
+        ]
+        results = http.handle_routes(session, routes=routes, hosts=hosts, workers=2)
+        self.assertEqual(len(results), 4)
+        self.assertEqual([result.host for result in results], [hosts[0], hosts[0], hosts[1], hosts[1]])
+        self.assertEqual([result.route.method for result in results], ["GET", "POST", "GET", "POST"])
+        for result in results:
+            self.assertEqual(result.success, True)
+
+    def test_handle_async_routes(self):
+        from hat.transport import AsyncSession
+        session = AsyncSession()
+        hosts = self.hosts + ["http://127.0.0.1:{}".format(server_port)]
+        routes = [
+            http.Route("/", method="GET", response=200, store=[Extractor("response.body-object.id", "id")]),
+            http.Route("/", method="POST", body={"id": "{id}"}, response=201),
+        ]
+        results = http.handle_routes(session, routes=routes, hosts=hosts)
+        self.assertEqual([result.host for result in results], [hosts[0], hosts[0], hosts[1], hosts[1]])
+        for result in results:
+            self.assertEqual(result.success, True)
+        self.assertEqual(results[0].response.json()["id"], 1)
+        self.assertEqual(results[1].response.status_code, 201)
+        self.assertEqual(results[1].response.json(), {"id": '1'})
+        self.assertEqual(results[1].to_dict()["request"]["body-object"], {"id": '1'})
+        self.assertIs(results[1].to_dict(), results[1].to_dict())
+
+    def test_timing(self):
+        from hat.transport import AsyncSession, create_session
+        routes = [
+            http.Route("/", method="POST", body={"id": "1"}, response=201),
+        ]
+        for session in (create_session({}, True), AsyncSession(), r):
+            results = http.handle_routes(session, routes=routes, hosts=self.hosts)
+            timing = results[0].to_dict()["timing"]
+            self.assertGreater(timing["total"], 0)
+            self.assertGreaterEqual(timing["total"], timing["ttfb"])
+            self.assertGreater(timing["request-bytes"], 0)
+            self.assertEqual(timing["response-bytes"], timing["request-bytes"])
+            if session is not r:
+                self.assertGreater(timing["connect"], 0)
+            collection = http.HTTPCollectionResult("timing", results + results)
+            self.assertEqual(collection.to_dict()["timing"]["requests"], 2)
+
+    def test_budgets(self):
+        routes = [
+            http.Route("/", method="GET", max_time=60, max_bytes=1000),
+            http.Route("/", method="GET", response=http.Response(200, max_ttfb=0)),
+            http.Route("/", method="GET", max_bytes=10),
+        ]
+        results = http.handle_routes(r, routes=routes, hosts=self.hosts)
+        self.assertEqual(results[0].success, True)
+        self.assertEqual(results[1].success, False)
+        self.assertTrue(results[1].message.startswith("Time to first byte"))
+        self.assertEqual(results[2].success, False)
+        self.assertTrue(results[2].message.endswith("exceeds budget of 10 bytes"))
+
+    def test_streamed_body_checks(self):
+        from hat.transport import AsyncSession
+        body = json.dumps(server.test_json).encode()
+        sha256 = hashlib.sha256(body).hexdigest()
+        routes = [
+            http.Route("/", method="GET", response=http.Response(200, sha256=sha256.upper(), length=len(body))),
+            http.Route("/", method="GET", response=http.Response(200, sha256="00" * 32)),
+            http.Route("/", method="GET", response=http.Response(200, body={"id": 2}, max_bytes=10)),
+            http.Route("/", method="GET", store=[Extractor("response.body-object.id", "id")]),
+            http.Route("/", method="GET", max_bytes=10, store=[Extractor("response.body-object.id", "id")]),
+        ]
+        for session in (r, AsyncSession()):
+            results = http.handle_routes(session, routes=routes, hosts=self.hosts, drop_bodies=True)
+            self.assertEqual([result.success for result in results], [True, False, False, True, False])
+            self.assertEqual(results[4].message, "Body download stopped, body exceeds budget of 10 bytes")
+            self.assertEqual(results[0].to_dict()["response"]["body-sha256"], sha256)
+            self.assertEqual(results[0].to_dict()["response"]["body-bytes"], len(body))
+            self.assertIsNone(results[0].response.content)
+            self.assertTrue(results[1].message.startswith("Body SHA-256"))
+            self.assertEqual(results[2].message, "Body download stopped, body exceeds budget of 10 bytes")
+            self.assertEqual(results[2].timing.response_bytes, 10)
+
+    def test_retention(self):
+        routes = [
+            http.Route("/", method="GET"),
+            http.Route("/", method="GET", response=404),
+        ]
+        full = http.handle_routes(r, routes=routes, hosts=self.hosts)
+        expected = [result.to_dict() for result in full]
+
+        results = http.HTTPCollectionResult("retain", http.handle_routes(r, routes=routes, hosts=self.hosts),
+                                            retain="failures")
+        passed, failed = results.results
+        self.assertIsNone(passed.response)
+        self.assertEqual(passed.to_dict()["response"], {"status-code": 200, "status": "OK"})
+        self.assertEqual(passed.to_dict()["timing"], passed.timing.to_dict())
+        self.assertIsNotNone(failed.response)
+
+        results = http.HTTPCollectionResult("spill", http.handle_routes(r, routes=routes, hosts=self.hosts),
+                                            retain="spill")
+        passed = results.results[0]
+        self.assertIsNone(passed.response)
+        self.assertEqual(passed.to_dict()["response"]["body"], expected[0]["response"]["body"])
+        self.assertEqual(pickle.loads(pickle.dumps(passed)).to_dict(), passed.to_dict())
+        with self.assertRaises(ValueError):
+            http.HTTPCollectionResult("unknown", full, retain="none")
+
+    def test_retention_per_route(self):
+        routes = [
+            http.Route("/", method="GET", store=[http.Extractor("response.body-object.id", "id")]),
+            http.Route("/", method="GET", response=404),
+        ]
+        storage = {}
+        passed, failed = http.handle_routes(r, routes=routes, hosts=self.hosts, storage=storage, retain="failures")
+        self.assertEqual(storage["id"], 1)
+        self.assertIsNone(passed.response)
+        self.assertIsNotNone(failed.response)
+        with self.assertRaises(ValueError):
+            http.handle_routes(r, routes=routes, hosts=self.hosts, retain="none")
+
+        results = http.HTTPCollectionResult("add", [], retain="failures")
+        results += http.handle_routes(r, routes=routes, hosts=self.hosts, retain="all")
+        self.assertIsNone(results.results[0].response)
+        self.assertFalse(results.success)
+        combined = http.HTTPCollectionResult("add", [], retain="failures") + \
+            http.handle_routes(r, routes=routes[:1], hosts=self.hosts, retain="all")
+        self.assertIsNone(combined.results[0].response)
+        self.assertTrue(combined.success)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,132 @@
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from hat import http, httpcache
+from hat.http import Route, Response
+from hat.transport import create_session
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests = []
+
+    def do_GET(self):
+        Handler.requests.append((self.path, self.headers.get("If-None-Match")))
+        headers = {"ETag": '"v1"'}
+        if self.path == "/fresh":
+            headers["Cache-Control"] = "max-age=60"
+        elif self.path == "/private":
+            headers = {"Cache-Control": "no-store"}
+        elif self.path == "/me":
+            headers = {"Cache-Control": "private, max-age=60", "Vary": "Cookie"}
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = b'{"id": 1}' if self.path != "/me" else ('{"user": "%s"}' % self.headers.get("Cookie")).encode()
+        self.send_response(200)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HttpCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.host = "http://127.0.0.1:{}/".format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        Handler.requests = []
+        httpcache.reset_caches()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        httpcache.reset_caches()
+
+    def visit(self, routes, options=None):
+        session = create_session(options if options is not None else {"cache": "run"})
+        results = http.handle_routes(session, [self.host], routes, workers=1)
+        self.assertTrue(all(r.success for r in results), [r.message for r in results])
+        return results
+
+    def test_fresh_and_revalidated(self):
+        routes = [Route(path, "GET", response=Response(200, body={"id": 1}))
+                  for path in ("/fresh", "/fresh", "/etag", "/etag")]
+        self.visit(routes)
+        self.visit(routes)
+        self.assertEqual(Handler.requests, [("/fresh", None), ("/etag", None)] + [("/etag", '"v1"')] * 3)
+        self.assertEqual(httpcache.cache_stats(), (3, 3, 2))
+
+    def test_no_store_and_invalidation(self):
+        self.visit([Route("/private", "GET"), Route("/private", "GET"), Route("/fresh", "GET"),
+                    Route("/fresh", "POST", response=204), Route("/fresh", "GET")])
+        self.assertEqual([path for path, _ in Handler.requests], ["/private", "/private", "/fresh", "/fresh"])
+
+    def test_budget_exceeded_not_stored(self):
+        routes = [Route("/fresh", "GET", max_bytes=4)] * 2
+        session = create_session({"cache": "run"})
+        results = http.handle_routes(session, [self.host], routes, workers=1)
+        self.assertTrue(all("exceeds budget" in r.message for r in results))
+        self.assertEqual(len(Handler.requests), 2)
+
+    def test_revalidated_entry_is_a_copy(self):
+        session = create_session({})
+        resp = session.get(self.host + "etag")
+        entry = httpcache.CacheEntry(resp, resp.content, {})
+        refreshed = entry.revalidated({"Cache-Control": "max-age=60", "ETag": '"v2"'})
+        self.assertEqual((entry.headers["ETag"], entry.lifetime), ('"v1"', 0))
+        self.assertEqual((refreshed.headers["ETag"], refreshed.lifetime), ('"v2"', 60))
+        self.assertTrue(refreshed.fresh())
+
+    def test_sessions_with_cookies(self):
+        sessions = []
+        for user in ("alice", "bob"):
+            session = create_session({"cache": "run", "session": True})
+            session.cookies.set("user", user)
+            sessions.append(session)
+        bodies = [session.get(self.host + "me").json() for session in sessions + sessions]
+        self.assertEqual(bodies, [{"user": "user=alice"}, {"user": "user=bob"}] * 2)
+        self.assertEqual([path for path, _ in Handler.requests], ["/me", "/me"])
+        self.assertEqual(httpcache.cache_stats(), (2, 0, 2))
+
+    def test_private_response_not_shared(self):
+        self.visit([Route("/me", "GET")] * 2)
+        self.visit([Route("/me", "GET")])
+        self.assertEqual([path for path, _ in Handler.requests], ["/me", "/me"])
+
+    def test_session_scope(self):
+        routes = [Route("/fresh", "GET")]
+        self.visit(routes, {"cache": "session"})
+        self.visit(routes, {"cache": "session"})
+        self.assertEqual(len(Handler.requests), 2)
+        self.assertEqual(httpcache.cache_stats(), (0, 0, 2))
+
+    def test_cacheable_assertion(self):
+        session = create_session({})
+        results = http.handle_routes(session, [self.host], [
+            Route("/fresh", "GET", response=Response(200, cacheable=True)),
+            Route("/private", "GET", response=Response(200, cacheable=True)),
+            Route("/private", "GET", response=Response(200, cacheable=False)),
+        ], workers=1)
+        self.assertEqual([r.success for r in results], [True, False, True])
+        self.assertIn("Cache-Control: no-store", results[1].message)
+        self.assertIsNone(httpcache.cache_stats())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+from multiprocessing import Process
+
+from hat import http, load, builtin
+from .server import WebServer, host_name, server_port
+
+
+class LoadUnitTests(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(load.percentile(values, 50), 50)
+        self.assertEqual(load.percentile(values, 99), 99)
+        self.assertEqual(load.percentile(values, 100), 100)
+        self.assertEqual(load.percentile([], 50), None)
+
+    def test_rate_limiter(self):
+        limiter = load.RateLimiter(100)
+        delays = [limiter.reserve() for _ in range(5)]
+        self.assertEqual(delays[0], 0)
+        self.assertAlmostEqual(delays[4], 0.04, delta=0.005)
+
+    def test_session_options_without_cache(self):
+        options = {"session": True, "cache": "run"}
+        self.assertEqual(load.session_options(options), {"session": True})
+        self.assertEqual(options["cache"], "run")
+
+
+class LoadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = WebServer(host_name, server_port)
+        self.process = Process(target=self.server.start_server)
+        self.process.start()
+
+    def tearDown(self):
+        self.process.kill()
+        self.server.stop_server()
+        self.process.join()
+        self.process.close()
+
+    def test_load_routes(self):
+        config = {
+            "hosts": ["http://{}:{}/".format(host_name, server_port)],
+            "routes": [
+                http.Route("/", "GET", response=200, store=[http.Extractor("response.body-object.id", "id")]),
+                http.Route("/", "POST", body={"id": "{id}"}, response=201),
+            ],
+            "options": {"session": True},
+        }
+        report = load.load(None, "test_routes", {}, {'c': '2', 'rps': '40', 'd': '0.5'}, config)
+        self.assertTrue(report.success)
+        self.assertEqual(len(report.routes), 2)
+        self.assertLessEqual(report.requests, 24)
+        for stats in report.routes.values():
+            self.assertEqual(len(stats.latencies), stats.requests)
+
+
+if __name__ == '__main__':
+    unittest.main()
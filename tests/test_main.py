@@ -0,0 +1,179 @@
+import os
+import sys
+import threading
+import unittest
+
+from hat import main
+
+
+class CaptureOutputTestCase(unittest.TestCase):
+    def test_capture_per_thread(self):
+        stdout = sys.stdout
+        outputs = {}
+        barrier = threading.Barrier(2)
+
+        def target(name):
+            with main.capture_output() as captured:
+                barrier.wait()
+                for i in range(100):
+                    print(name, i)
+                barrier.wait()
+                outputs[name] = captured.getvalue()
+
+        threads = [threading.Thread(target=target, args=(name,)) for name in ("first", "second")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for name in ("first", "second"):
+            lines = outputs[name].strip().split("\n")
+            self.assertEqual(len(lines), 100)
+            self.assertTrue(all(line.startswith(name + " ") for line in lines))
+        self.assertIs(sys.stdout, stdout)
+
+    def test_runall_parallel(self):
+        tasks = dict(main.tasks)
+        main.tasks.clear()
+        try:
+            for i in range(8):
+                t = main.TestWrapper()
+                t.name = f"test_{i}"
+                t.func = (lambda i: lambda: print(f"output {i}") or i % 2 == 0)(i)
+                main.tasks[t.name] = t
+            results = list(main.runall(None, {}, {'p': '4'}))
+        finally:
+            main.tasks.clear()
+            main.tasks.update(tasks)
+
+        self.assertEqual(len(results), 8)
+        for lines, success in results:
+            i = int(lines[0].split("_")[1].rstrip(": "))
+            self.assertEqual(lines[1], f"output {i}")
+            self.assertEqual(success, i % 2 == 0)
+
+    def test_host_threads_shared(self):
+        tasks = dict(main.tasks)
+        main.tasks.clear()
+        try:
+            for i in range(2):
+                t = main.TestWrapper()
+                t.name = f"test_{i}"
+                t.func = lambda: main.host_workers(8)
+                main.tasks[t.name] = t
+            shared = [success for _, success in main.runall(None, {}, {'p': '4'})]
+            alone = [success for _, success in main.run_tests(None, ["test_0"], {}, {'p': '4'})]
+        finally:
+            main.tasks.clear()
+            main.tasks.update(tasks)
+        self.assertEqual(shared, [4, 4])
+        self.assertEqual(alone, [8])
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tasks = dict(main.tasks)
+        main.tasks.clear()
+        self.calls = []
+
+    def tearDown(self):
+        main.tasks.clear()
+        main.tasks.update(self.tasks)
+
+    def add(self, name, func, depends=()):
+        t = main.TestWrapper()
+        t.name = name
+        t.func = func
+        t.args = func.__code__.co_varnames[:func.__code__.co_argcount]
+        t.depends = list(depends)
+        main.tasks[name] = t
+
+    def test_dependencies_run_once(self):
+        def login(storage=None):
+            self.calls.append("login")
+            storage["token"] = "secret"
+            return True
+
+        def create(login=None, storage=None):
+            self.calls.append("create")
+            return login and storage["token"] == "secret"
+
+        def delete(storage=None):
+            self.calls.append("delete")
+            return storage["token"] == "secret"
+
+        self.add("create", create, ["login"])
+        self.add("delete", delete, ["login"])
+        self.add("login", login)
+        for workers in (1, 3):
+            self.calls.clear()
+            results = list(main.Scheduler(None, {}, {}, workers).run(list(main.tasks)))
+            self.assertEqual(len(results), 3)
+            self.assertTrue(all(success for _, success in results))
+            self.assertEqual(self.calls.count("login"), 1)
+            self.assertEqual(self.calls[0], "login")
+
+    def test_failed_dependency(self):
+        self.add("setup", lambda: False)
+        self.add("dependent", lambda: True, ["setup"])
+        self.add("unknown", lambda: True, ["missing"])
+        results = list(main.Scheduler(None, {}, {}).run(["dependent", "unknown"]))
+        messages = {lines[0]: lines[1] for lines, _ in results if len(lines) > 1}
+        self.assertEqual(messages["dependent: "], "Skipped, dependency 'setup' failed")
+        self.assertEqual(messages["unknown: "], "Skipped, dependency 'missing' failed")
+        self.assertIn([["Test 'missing' not found"], False], results)
+        self.assertFalse(any(success for _, success in results))
+
+    def test_circular_dependency(self):
+        self.add("a", lambda: True, ["b"])
+        self.add("b", lambda: True, ["a"])
+        results = list(main.Scheduler(None, {}, {}).run(["a"]))
+        self.assertEqual(results, [[["a: ", "Skipped, circular dependency"], False],
+                                   [["b: ", "Skipped, circular dependency"], False]])
+
+    def test_components(self):
+        self.add("a", lambda: True)
+        self.add("b", lambda: True, ["a"])
+        self.add("c", lambda: True)
+        self.add("d", lambda: True, ["c", "a"])
+        self.add("e", lambda: True)
+        components = main.Scheduler(None).components(["b", "c", "d", "e"])
+        self.assertEqual(sorted(map(sorted, components)), [["a", "b", "c", "d"], ["e"]])
+
+
+class SuiteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tasks = dict(main.tasks)
+        main.tasks.clear()
+        self.dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "suite")
+
+    def tearDown(self):
+        main.tasks.clear()
+        main.tasks.update(self.tasks)
+
+    def test_find_hatfiles(self):
+        files = main.find_hatfiles([self.dir])
+        self.assertEqual([os.path.relpath(f, self.dir) for f in files],
+                         ["billing_hatfile.py", os.path.join("users", "hatfile.py")])
+        self.assertEqual([main.hatfile_namespace(f, self.dir) for f in files], ["billing", "users"])
+
+    def test_load_suite(self):
+        suite = main.load_suite([self.dir])
+        main.setup(suite, {})
+        self.assertEqual(sorted(main.tasks), ["billing:test_config", "billing:test_routes",
+                                              "users:test_config", "users:test_login", "users:test_routes"])
+        self.assertEqual(main.tasks["users:test_config"].depends, ["users:test_login"])
+
+        results = list(main.run_tests(suite, ["users:test-config", "billing:test-config"], {}, {}))
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(success for _, success in results))
+
+        description = main.describe(suite)
+        routes = description["tests"]["users:test_routes"]["long_help"]
+        self.assertIn("    1. List users", routes)
+        self.assertNotIn("    1. List invoices", routes)
+        self.assertIn("users:test_login", main.list_tests(suite, None, {}, description))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+
+import requests
+
+from hat import main, http, profiler
+from hat.http import Route, Response, HTTPCollectionResult
+from hat.serve import MockServer
+from .server import LocalServer
+
+
+class ProfilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tasks = dict(main.tasks)
+        main.tasks.clear()
+        self.directory = tempfile.TemporaryDirectory()
+        self.server = LocalServer(MockServer([Route("/items", "GET", response=Response(200, body={"id": 1}))],
+                                             latency=(0.02, 0.02)).handler()).start()
+        self.host = self.server.host
+
+    def tearDown(self):
+        main.tasks.clear()
+        main.tasks.update(self.tasks)
+        self.server.stop()
+        self.directory.cleanup()
+
+    def add(self, name, func):
+        t = main.TestWrapper()
+        t.name = name
+        t.func = func
+        main.tasks[name] = t
+
+    def test_profile_per_test(self):
+        routes = [Route("/items", "GET", response=Response(200, body={"id": 1}))] * 3
+        self.add("test_items", lambda: HTTPCollectionResult(
+            "items", http.handle_routes(requests.session(), [self.host], routes, workers=1)))
+        self.add("test_passes", lambda: True)
+        before = len(profiler.profiles())
+        results = list(main.runall(None, {}, {'profile': self.directory.name, 'p': '4'}))
+        self.assertTrue(all(main.is_success(r) for r in results))
+
+        profiles = {p.name: p for p in profiler.profiles()[before:]}
+        self.assertEqual(set(profiles), {"test_items", "test_passes"})
+        items = profiles["test_items"]
+        self.assertTrue(os.path.exists(os.path.join(self.directory.name, "test_items.prof")))
+        self.assertGreaterEqual(items.network, 0.06)
+        self.assertLessEqual(items.network, items.wall)
+        self.assertGreater(items.groups["hat"], 0)
+        self.assertEqual(profiles["test_passes"].network, 0.0)
+        self.assertGreater(len(profiler.hot_functions([items], 5)), 0)
+
+    def test_profile_process_pool(self):
+        self.add("test_passes", lambda: True)
+        before = len(profiler.profiles())
+        list(main.runall(None, {}, {'profile': self.directory.name, 'p': '2', 'pool': 'process'}))
+        self.assertEqual([p.name for p in profiler.profiles()[before:]], ["test_passes"])
+
+    def test_routes_not_parallel(self):
+        class Hatfile:
+            OPTIONS = {"parallel": 8}
+
+        main.setup(Hatfile, {'profile': True, 'p': '4'})
+        try:
+            self.assertEqual(http.current_config()['options']['parallel'], 1)
+        finally:
+            http.reset_config()
+
+    def test_profile_path(self):
+        self.assertEqual(profiler.profile_path("out", "users:test-login"), os.path.join("out", "users_test-login.prof"))
+        self.assertEqual(profiler.profile_directory({'profile': True}), profiler.DEFAULT_DIRECTORY)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import json
+import unittest
+
+import requests
+
+from hat import http
+from hat.http import Route, Response, Extractor, ToInt
+from hat.serve import MockServer, path_pattern, parse_latency
+from .server import LocalServer
+
+
+class ServeTestCase(unittest.TestCase):
+    def start(self, routes, **kwargs):
+        self.server = LocalServer(MockServer(routes, **kwargs).handler()).start()
+        self.host = self.server.host
+
+    def tearDown(self):
+        if hasattr(self, 'server'):
+            self.server.stop()
+
+    def test_path_pattern(self):
+        pattern, names = path_pattern("/users/{userId}/items/{item.id}")
+        self.assertEqual(names, ["userId", "item"])
+        m = pattern.match("/users/7/items/3")
+        self.assertEqual((m.group("g0"), m.group("g1")), ("7", "3"))
+        self.assertIsNone(pattern.match("/users/7/items"))
+
+    def test_parse_latency(self):
+        self.assertEqual(parse_latency("0.1"), (0.1, 0.1))
+        self.assertEqual(parse_latency("0.01-0.05"), (0.01, 0.05))
+        with self.assertRaises(ValueError):
+            parse_latency("0.05-0.01")
+
+    def test_routes_pass_against_mock(self):
+        routes = [
+            Route("/users", "POST", body={"name": "test"},
+                  response=Response(201, headers={"Location": "/users/7"}, body={"id": 7, "name": "test"}),
+                  store=[Extractor("response.body-object.id", "userId")]),
+            Route("/users/{userId}", "GET", response=Response(200, body={"id": ToInt("{userId}"), "name": "test"})),
+            Route("/users/{userId}", "GET", response=Response(200, body={"id": 7, "name": "test", "active": True})),
+        ]
+        self.start(routes)
+        results = http.handle_routes(requests.session(), [self.host], routes, workers=1)
+        self.assertTrue(all(r.success for r in results), [r.message for r in results])
+        self.assertEqual(results[0].to_dict()["response"]["headers"]["Location"], "/users/7")
+        self.assertEqual(results[2].to_dict()["response"]["body-object"]["active"], True)
+
+    def test_placeholders(self):
+        server = MockServer([Route("/users/{userId}", "PUT",
+                                   response=Response(200, body={"id": ToInt("{userId}"), "name": "{name}",
+                                                                "group": "{group}", "size": ToInt("{size}")}))])
+        code, _, headers, body = server.respond("PUT", "/users/7?group=admins", b'{"name": "x"}')
+        self.assertEqual(code, 200)
+        self.assertEqual(headers["Content-Type"], "application/json")
+        self.assertEqual(json.loads(body), {"id": 7, "name": "x", "group": "admins", "size": 0})
+
+    def test_unknown_route(self):
+        self.start([Route("/users", "GET")])
+        resp = requests.get(self.host + "missing")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(requests.post(self.host + "users").status_code, 404)
+
+    def test_error_injection(self):
+        self.start([Route("/users", "GET", response=Response(200, body=[]))], error_rate=1.0, error_status=503)
+        resp = requests.get(self.host + "users")
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(json.loads(resp.text), {"error": "injected"})
+
+
+if __name__ == '__main__':
+    unittest.main()
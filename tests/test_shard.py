@@ -0,0 +1,112 @@
+import threading
+import unittest
+from unittest import mock
+
+from hat import builtin, cmd, history, http, main, shard
+from hat.http import Route, Extractor
+
+
+class ShardTestCase(unittest.TestCase):
+    def test_parse_shard(self):
+        self.assertEqual(shard.parse_shard("2/3"), (2, 3))
+        for text in ("0/3", "4/3", "1", "a/b"):
+            with self.assertRaises(ValueError):
+                shard.parse_shard(text)
+
+    def test_assign(self):
+        self.assertEqual(shard.assign([5, 1, 1, 3, 2], 2), [0, 0, 1, 1, 1])
+        self.assertEqual(shard.assign([1, 1, 1], 3), [0, 1, 2])
+
+    def test_shard_routes(self):
+        routes = [
+            Route("/login", "POST", store=[Extractor("response.body-object.token", "token")]),
+            Route("/users", "GET"),
+            Route("/me", "GET", headers={"Authorization": "Bearer {token}"}),
+            Route("/items", "GET"),
+        ]
+        self.assertEqual(http.route_chains(routes), [[0, 2], [1], [3]])
+        hosts = ["http://a/", "http://b/"]
+        pairs = [(host, route) for i in (1, 2, 3) for host, rs in http.shard_routes(hosts, routes, (i, 3)) for route in rs]
+        self.assertEqual(len(pairs), 8)
+        self.assertEqual(len(set((host, route.path) for host, route in pairs)), 8)
+        for i in (1, 2, 3):
+            for host, rs in http.shard_routes(hosts, routes, (i, 3)):
+                paths = [route.path for route in rs]
+                self.assertEqual("/login" in paths, "/me" in paths)
+
+    def test_sharded_hosts_in_parallel(self):
+        config = {
+            "hosts": ["http://a/", "http://b/", "http://c/"],
+            "routes": [Route("/users", "GET"), Route("/items", "GET")],
+            "options": {"shard": "1/1", "parallel": 3},
+        }
+        barrier = threading.Barrier(3, timeout=5)
+
+        def handle_host(session, host, routes, host_storage, drop_bodies=False, retain="all"):
+            barrier.wait()
+            return [(host, route.path) for route in routes]
+
+        with mock.patch.object(http, "handle_host", handle_host):
+            results = builtin.test_routes.hat_task.func(config=config)
+        self.assertEqual(sorted(results), sorted((h, p) for h in config["hosts"] for p in ("/users", "/items")))
+
+    def test_shard_names(self):
+        tasks = dict(main.tasks)
+        main.tasks.clear()
+        try:
+            for name, depends in (("a", []), ("b", ["a"]), ("c", []), ("d", []), ("routes", [])):
+                t = main.TestWrapper()
+                t.name = name
+                t.func = lambda: True
+                t.depends = depends
+                t.shards_itself = name == "routes"
+                main.tasks[name] = t
+            names = list(main.tasks)
+            durations = {"a": 1, "b": 1, "c": 3, "d": 0.5}
+            shards = [main.shard_names(names, (i, 2), durations) for i in (1, 2)]
+        finally:
+            main.tasks.clear()
+            main.tasks.update(tasks)
+        self.assertEqual(shards, [["c", "routes"], ["a", "b", "d", "routes"]])
+
+    def test_shards_with_different_histories(self):
+        tasks = dict(main.tasks)
+        main.tasks.clear()
+        try:
+            for name in ("t0", "t1", "t2", "t3"):
+                t = main.TestWrapper()
+                t.name = name
+                t.func = lambda: True
+                main.tasks[name] = t
+            first = history.History("first.json")
+            second = history.History("second.json")
+            second.tests = {"t0": {"success": False, "duration": 5.0}, "t1": {"success": True, "duration": 0.1}}
+            shards = [main.shard_names(["t0", "t1", "t2", "t3"], (1, 2), cmd.shard_durations({}, first)),
+                      main.shard_names(second.failed_first(["t3", "t2", "t1", "t0"]), (2, 2),
+                                       cmd.shard_durations({}, second))]
+        finally:
+            main.tasks.clear()
+            main.tasks.update(tasks)
+        self.assertEqual(sorted(shards[0] + shards[1]), ["t0", "t1", "t2", "t3"])
+
+    def test_merge(self):
+        first = [
+            {"success": True, "message": "test_a: "},
+            {"success": True, "title": "ROUTES", "results": [{"url": "a"}],
+             "timing": {"requests": 1, "total": 0.5, "mean": 0.5, "max": 0.5}},
+        ]
+        second = [
+            {"success": False, "title": "ROUTES", "results": [{"url": "b"}, {"url": "c"}],
+             "timing": {"requests": 2, "total": 0.5, "mean": 0.25, "max": 0.3}},
+            {"success": False, "message": "test_b: "},
+        ]
+        merged = shard.merge([first, second])
+        self.assertEqual([r.get("title", r.get("message")) for r in merged], ["test_a: ", "ROUTES", "test_b: "])
+        self.assertEqual(merged[1]["success"], False)
+        self.assertEqual([r["url"] for r in merged[1]["results"]], ["a", "b", "c"])
+        self.assertEqual(merged[1]["timing"], {"requests": 3, "total": 1.0, "mean": 1.0 / 3, "max": 0.5})
+        self.assertEqual(len(first[1]["results"]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import os
+import tempfile
+import unittest
+
+from hat import builtin, http, main, watch
+
+HATFILE = """
+from hat.decorators import test
+
+
+@test()
+def test_a():
+    return {a}
+
+
+@test(depends=[test_a])
+def test_b():
+    return True
+
+
+@test()
+def test_c():
+    return True
+"""
+
+
+class WatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tasks = dict(main.tasks)
+        # tasks registered by other tests' imports would be kept by the reload
+        main.tasks.clear()
+        self.dir = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.dir.name, "hatfile.py")
+        self.write("True", 1)
+
+    def tearDown(self):
+        main.tasks.clear()
+        main.tasks.update(self.tasks)
+        self.dir.cleanup()
+
+    def write(self, a, mtime):
+        with open(self.file, "w") as f:
+            f.write(HATFILE.format(a=a))
+        os.utime(self.file, ns=(mtime * 10 ** 9, mtime * 10 ** 9))
+
+    def test_rerun_changed(self):
+        watcher = watch.Watcher([self.file])
+        self.assertEqual(watcher.select(watcher.load()), ["test_a", "test_b", "test_c"])
+        self.assertIsNone(watcher.poll())
+
+        self.write("True", 2)
+        self.assertEqual(watcher.poll(), [])
+        self.write("False", 3)
+        self.assertEqual(watcher.poll(), ["test_a", "test_b"])
+        results = list(main.run_tests(watcher.tests, ["test_a"], {}, {}))
+        self.assertEqual(results[0][1], False)
+
+        watcher.pattern = "test_c"
+        self.write("1 == 2", 4)
+        self.assertEqual(watcher.poll(), ["test_a", "test_b", "test_c"])
+
+
+GLOBALS_HATFILE = """
+from hat.decorators import test
+from hat.http import Route
+
+USERS = [Route("/users", "GET", response={code})]
+
+
+def count():
+    return len(USERS)
+
+
+@test()
+def test_users():
+    return count() == 1
+
+
+@test()
+def test_other():
+    return True
+"""
+
+
+class WatcherGlobalsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tasks = dict(main.tasks)
+        main.tasks.clear()
+        self.dir = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.dir.name, "hatfile.py")
+
+    def tearDown(self):
+        main.tasks.clear()
+        main.tasks.update(self.tasks)
+        self.dir.cleanup()
+
+    def write(self, code, mtime):
+        with open(self.file, "w") as f:
+            f.write(GLOBALS_HATFILE.format(code=code))
+        os.utime(self.file, ns=(mtime * 10 ** 9, mtime * 10 ** 9))
+
+    def test_rerun_changed_globals(self):
+        self.write(200, 1)
+        watcher = watch.Watcher([self.file])
+        watcher.load()
+        self.write(200, 2)
+        self.assertEqual(watcher.poll(), [])
+        self.write(404, 3)
+        self.assertEqual(watcher.poll(), ["test_users"])
+
+
+ROUTES_HATFILE = """
+from hat.builtin import test_routes
+from hat.http import Route
+
+HOSTS = ["http://localhost:8080/"]
+ROUTES = [Route("{path}", "GET")]
+"""
+
+
+class WatcherRoutesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tasks = dict(main.tasks)
+        # like the first import of hat.builtin in a new process
+        main.tasks.clear()
+        main.register(builtin.test_routes.hat_task)
+        self.dir = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.dir.name, "hatfile.py")
+
+    def tearDown(self):
+        main.tasks.clear()
+        main.tasks.update(self.tasks)
+        http.reset_config()
+        self.dir.cleanup()
+
+    def write(self, path, mtime):
+        with open(self.file, "w") as f:
+            f.write(ROUTES_HATFILE.format(path=path))
+        os.utime(self.file, ns=(mtime * 10 ** 9, mtime * 10 ** 9))
+
+    def test_rerun_changed_routes(self):
+        self.write("/users", 1)
+        watcher = watch.Watcher([self.file])
+        self.assertIn("test_routes", watcher.select(watcher.load()))
+        self.write("/users", 2)
+        self.assertEqual(watcher.poll(), [])
+        self.write("/items", 3)
+        self.assertEqual(watcher.poll(), ["test_routes"])
+        self.assertIn("test_routes", main.tasks)
+
+
+if __name__ == '__main__':
+    unittest.main()